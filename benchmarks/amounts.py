@@ -0,0 +1,105 @@
+#   ledger-pyreport
+#   Copyright © 2020  Lee Yingtong Li (RunasSudo)
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Time parse_amount on amount strings as Ledger formats them, against parsing without the cache of parsed strings, and as before the cache was added
+# Usage: python benchmarks/amounts.py [number of amount strings]
+
+import synthetic # Sets up the config, so must be imported first
+
+from decimal import Decimal
+import gc
+import random
+import sys
+import time
+
+from ledger_pyreport import ledger as ledger_module
+from ledger_pyreport.model import *
+
+num_amounts = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+# Mostly amounts in the report commodity, with some foreign currency and shares at cost, and a quoted commodity
+def random_amount(rng, num_values):
+	kind = rng.random()
+	number = rng.randrange(1, num_values) / 100
+	sign = '-' if rng.random() < 0.5 else ''
+	if kind < 0.85:
+		return '${}{:,.2f}'.format(sign, number)
+	elif kind < 0.9:
+		return '{}{:,.2f} EUR {{${}}}'.format(sign, number, rng.choice(['1.45', '1.52', '1.61']))
+	elif kind < 0.95:
+		return '{}{} "FUND 1" {{${}}}'.format(sign, rng.randrange(1, 100), rng.choice(['1.05', '1.10']))
+	else:
+		return '{}{} SHARE {{${}}}'.format(sign, rng.randrange(1, 100), rng.choice(['10.50', '12.25', '9.80']))
+
+# parse_amount as it was before parsed strings were cached, for comparison
+def parse_amount_original(amount, ledger=None):
+	if '{' in amount:
+		amount_str = amount[:amount.index('{')].strip()
+		price_str = amount[amount.index('{')+1:amount.index('}')].strip()
+	else:
+		amount_str = amount
+		price_str = None
+	
+	price = parse_amount_original(price_str, ledger) if price_str else None
+	
+	if amount_str[0] in list('0123456789-'):
+		# Commodity follows number
+		result = ledger_module.RE_COMMODITY1.match(amount_str)
+		amount_num = Decimal(result.group(1).replace(',', ''))
+		commodity = Commodity(result.group(3).strip('"'), False, len(result.group(2)) > 0, price)
+	else:
+		# Commodity precedes number
+		result = ledger_module.RE_COMMODITY2.match(amount_str)
+		amount_num = Decimal(result.group(3).replace(',', ''))
+		commodity = Commodity(result.group(1).strip('"'), True, len(result.group(2)) > 0, price)
+	
+	if ledger is not None:
+		commodity = ledger.intern_commodity(commodity)
+	
+	return Amount(amount_num, commodity)
+
+def parse_amount_uncached(amount, ledger):
+	amount_num, commodity = ledger_module.parse_amount_cached.__wrapped__(amount)
+	return Amount(amount_num, ledger.intern_commodity(commodity))
+
+# Journals where the same amounts recur, and where most amounts are distinct
+for corpus, num_values in [('Recurring amounts', 2000), ('Mostly distinct amounts', 10000000)]:
+	rng = random.Random(19)
+	amounts = [random_amount(rng, num_values) for _ in range(num_amounts)]
+	print('{}: {} amount strings, {} distinct'.format(corpus, len(amounts), len(set(amounts))))
+	
+	results = []
+	for name, parse in [('Original', parse_amount_original), ('Uncached', parse_amount_uncached), ('parse_amount', ledger_module.parse_amount)]:
+		ledger = Ledger(None)
+		ledger_module.parse_amount_cached.cache_clear()
+		
+		# As in timeit, garbage collection is disabled, so that the time does not depend on the results kept from the earlier runs
+		gc.disable()
+		start = time.perf_counter()
+		results.append([parse(amount, ledger) for amount in amounts])
+		elapsed = time.perf_counter() - start
+		gc.enable()
+		
+		print('{}: {:.2f} s ({:.2f} µs per amount)'.format(name, elapsed, elapsed / num_amounts * 1e6))
+	print('Cache: {}'.format(ledger_module.parse_amount_cached.cache_info()))
+	
+	# The cache must not change the results
+	for parsed in zip(*results):
+		if len(set((a.amount.as_tuple(), a.commodity.key, a.commodity.is_prefix, a.commodity.is_space) for a in parsed)) != 1:
+			print('Different results: {}'.format(parsed))
+			sys.exit(1)
+	print('Results are the same')
+	print()
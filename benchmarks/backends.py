@@ -0,0 +1,93 @@
+#   ledger-pyreport
+#   Copyright © 2020  Lee Yingtong Li (RunasSudo)
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compare parsing Ledger's CSV output (ledger_backend: csv) with its XML output (ledger_backend: xml)
+# Usage: python benchmarks/backends.py [number of transactions] [journal file]
+# The output of Ledger is simulated from a synthetic ledger, so that only the parsing is timed
+# If a journal file is given, the whole of parse_ledger is also timed on it with each backend, which requires Ledger
+
+import synthetic # Sets up the config, so must be imported first
+
+import gc
+import io
+import sys
+import time
+from xml.sax.saxutils import escape
+
+from ledger_pyreport import ledger as ledger_module
+from ledger_pyreport.config import config
+from ledger_pyreport.model import *
+
+num_transactions = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+journal_file = sys.argv[2] if len(sys.argv) > 2 else None
+
+def csv_quote(value):
+	return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def csv_output(ledger):
+	# As produced with ledger_module.CSV_FORMAT
+	lines = []
+	for transaction in ledger.transactions:
+		for posting in transaction.postings:
+			lines.append(','.join(csv_quote(v) for v in [transaction.id, transaction.date.strftime('%Y-%m-%d'), transaction.code, transaction.description, posting.account.name, posting.amount.tostr(False), posting.comment or '', str(posting.state.value), '', 'ledger.journal']) + '\n')
+	return lines
+
+def xml_amount(amount, tag='amount'):
+	commodity = amount.commodity
+	annotation = '<annotation>{}</annotation>'.format(xml_amount(commodity.price, 'price')) if commodity.price else ''
+	flags = ('P' if commodity.is_prefix else '') + ('S' if commodity.is_space else '')
+	return '<{0}><commodity flags="{1}"><symbol>{2}</symbol>{3}</commodity><quantity>{4}</quantity></{0}>'.format(tag, flags, escape(commodity.name), annotation, amount.amount)
+
+def xml_output(ledger):
+	# As produced by Ledger's xml command, including the running total of each posting
+	lines = ['<?xml version="1.0" encoding="utf-8"?>\n<ledger version="197120">\n<commodities/>\n<accounts/>\n<transactions>\n']
+	states = {Posting.State.CLEARED: ' state="cleared"', Posting.State.PENDING: ' state="pending"'}
+	for transaction in ledger.transactions:
+		lines.append('<transaction><date>{:%Y/%m/%d}</date><payee>{}</payee><metadata><value key="UUID"><string>{}</string></value></metadata><postings>\n'.format(transaction.date, escape(transaction.description), escape(transaction.id)))
+		for posting in transaction.postings:
+			note = '<note>{}</note>'.format(escape(posting.comment)) if posting.comment else ''
+			lines.append('<posting{}><account ref="0x1"><name>{}</name></account><post-amount>{}</post-amount>{}<total>{}</total></posting>\n'.format(states.get(posting.state, ''), escape(posting.account.name), xml_amount(posting.amount), note, xml_amount(posting.amount)))
+		lines.append('</postings></transaction>\n')
+	lines.append('</transactions>\n</ledger>\n')
+	return lines
+
+def transactions_key(transactions):
+	return [(t.date, t.description, [(p.account.name, p.amount.tostr(False), p.comment or '', p.state) for p in t.postings]) for t, _ in transactions]
+
+source = synthetic.make_ledger(num_transactions)
+outputs = {'csv': csv_output(source), 'xml': xml_output(source)}
+
+results = {}
+for backend, parse in [('csv', ledger_module.parse_csv), ('xml', ledger_module.parse_xml)]:
+	size = sum(len(line) for line in outputs[backend])
+	gc.collect()
+	start = time.perf_counter()
+	results[backend] = parse(Ledger(None), iter(outputs[backend]), set())
+	elapsed = time.perf_counter() - start
+	print('{}: {:.1f} MB of output parsed in {:.2f} s ({:.1f} µs per transaction)'.format(backend.upper(), size / 1e6, elapsed, elapsed / num_transactions * 1e6))
+
+if transactions_key(results['csv']) != transactions_key(results['xml']):
+	print('CSV and XML give different transactions')
+	sys.exit(1)
+print('CSV and XML give the same transactions')
+
+if journal_file:
+	config['ledger_file'] = journal_file
+	for backend in ('csv', 'xml'):
+		config['ledger_backend'] = backend
+		start = time.perf_counter()
+		ledger = ledger_module.parse_ledger()
+		print('parse_ledger ({}): {} transactions in {:.2f} s'.format(backend, len(ledger.transactions), time.perf_counter() - start))
@@ -0,0 +1,109 @@
+#   ledger-pyreport
+#   Copyright © 2020  Lee Yingtong Li (RunasSudo)
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Check that refreshing a ledger incrementally (incremental_refresh) gives the same transactions, IDs and UUIDs as parsing the journal in full,
+# and that it falls back to a full parse where it cannot
+# Usage: python benchmarks/incremental.py
+# Requires Ledger; the journal is written to a temporary directory
+
+import synthetic # Sets up the config, so must be imported first
+
+import os
+import tempfile
+import time
+
+from ledger_pyreport import ledger as ledger_module
+from ledger_pyreport.config import config
+
+MAIN = '''account Assets:Cash
+account Income:Sales
+account Expenses:Food
+include included.journal
+
+2020-01-01 Sale
+    ; UUID: sale-1
+    Assets:Cash  $100
+    Income:Sales
+
+2020-01-05 Lunch ; UUID: lunch-1
+    Expenses:Food  $10
+    Assets:Cash
+'''
+
+INCLUDED = '''2020-01-03 Groceries
+    ; UUID: groceries-1
+    Expenses:Food  $5
+    Assets:Cash
+'''
+
+def transaction(date, payee, uuid=None):
+	return '\n{} {}\n{}    Expenses:Food  $1\n    Assets:Cash\n'.format(date, payee, '    ; UUID: {}\n'.format(uuid) if uuid else '')
+
+# (description, main journal, included file, text appended to the main journal, text appended to the included file, whether the refresh should be incremental)
+CASES = [
+	('append to journal', MAIN, INCLUDED, transaction('2020-01-05', 'Dinner', 'dinner-1') + transaction('2020-01-02', 'Coffee', 'coffee-1'), '', True),
+	('append without UUID', MAIN, INCLUDED, transaction('2020-01-06', 'Dinner'), '', False),
+	('append with UUID in use', MAIN, INCLUDED, transaction('2020-01-06', 'Dinner', 'sale-1'), '', False),
+	('append to included file', MAIN, INCLUDED, '', transaction('2020-01-04', 'Snack', 'snack-1'), True),
+	('append to included file on date of other file', MAIN, INCLUDED, '', transaction('2020-01-05', 'Snack', 'snack-1'), False),
+	('append to included file with journal without UUIDs', MAIN + transaction('2020-01-07', 'Dinner'), INCLUDED, '', transaction('2020-01-04', 'Snack', 'snack-1'), False),
+	('append to included file without UUIDs', MAIN, INCLUDED + transaction('2020-01-02', 'Coffee'), '', transaction('2020-01-04', 'Snack'), False),
+]
+
+def ledger_key(ledger):
+	transactions = [(t.id, t.uuid, t.date, t.description, [(p.account.name, str(p.amount), p.state) for p in t.postings]) for t in ledger.transactions]
+	sources = {path: [t.uuid for t in ts] for path, ts in ledger.sources.items()}
+	return transactions, sources
+
+def write(path, text, mode='w'):
+	with open(path, mode, encoding='utf-8') as f:
+		f.write(text)
+
+with tempfile.TemporaryDirectory() as directory:
+	config['ledger_file'] = os.path.join(directory, 'main.journal')
+	included_file = os.path.join(directory, 'included.journal')
+
+	failed = False
+	for description, main, included, main_append, included_append, expect_incremental in CASES:
+		write(config['ledger_file'], main)
+		write(included_file, included)
+
+		old_key = ledger_module.journal_fingerprint()
+		old_files = ledger_module.read_journal_files()
+		old_ledger = ledger_module.parse_ledger()
+
+		# Ensure the modification times differ
+		time.sleep(0.01)
+		if main_append:
+			write(config['ledger_file'], main_append, 'a')
+		if included_append:
+			write(included_file, included_append, 'a')
+
+		refreshed = ledger_module.refresh_ledger(ledger_module.journal_fingerprint(), old_key, old_ledger, old_files)
+		full = ledger_module.parse_ledger()
+
+		if refreshed is None:
+			result = 'full parse'
+			ok = not expect_incremental
+		else:
+			result = 'incremental, ' + ('same as full parse' if ledger_key(refreshed[0]) == ledger_key(full) else 'DIFFERENT from full parse')
+			ok = expect_incremental and ledger_key(refreshed[0]) == ledger_key(full)
+
+		print('{}: {}{}'.format(description, result, '' if ok else ' (FAILED)'))
+		failed = failed or not ok
+
+	if failed:
+		raise SystemExit(1)
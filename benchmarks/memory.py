@@ -0,0 +1,42 @@
+#   ledger-pyreport
+#   Copyright © 2020  Lee Yingtong Li (RunasSudo)
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Memory used by a parsed ledger, per posting
+# Usage: python benchmarks/memory.py [number of transactions]
+
+import synthetic # Sets up the config, so must be imported first
+
+import sys
+import tracemalloc
+
+from ledger_pyreport.model import *
+
+num_transactions = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+tracemalloc.start()
+ledger = synthetic.make_ledger(num_transactions)
+used, peak = tracemalloc.get_traced_memory()
+tracemalloc.stop()
+
+num_postings = sum(len(t.postings) for t in ledger.transactions)
+print('{} transactions, {} postings'.format(len(ledger.transactions), num_postings))
+print('{:.0f} bytes per posting ({:.1f} MB in total, peak {:.1f} MB)'.format(used / num_postings, used / 1e6, peak / 1e6))
+
+# The size of each object itself, which __slots__ keeps free of a per-instance __dict__
+transaction = ledger.transactions[0]
+posting = transaction.postings[0]
+for obj in (transaction, posting, posting.amount):
+	print('{}: {} bytes{}'.format(type(obj).__name__, sys.getsizeof(obj), '' if not hasattr(obj, '__dict__') else ' + __dict__ of {} bytes'.format(sys.getsizeof(obj.__dict__))))
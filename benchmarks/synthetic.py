@@ -0,0 +1,76 @@
+#   ledger-pyreport
+#   Copyright © 2020  Lee Yingtong Li (RunasSudo)
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Synthetic ledgers for the benchmarks, which can be run from anywhere, e.g. python benchmarks/memory.py
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEMO_DIR = os.path.join(ROOT_DIR, 'demo')
+
+# Use the demo config unless another is given, from the demo directory so that its extension is found
+if 'LEDGER_PYREPORT_CONFIG' not in os.environ:
+	os.environ['LEDGER_PYREPORT_CONFIG'] = os.path.join(DEMO_DIR, 'config.yml')
+	os.chdir(DEMO_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from ledger_pyreport.config import config
+from ledger_pyreport.model import *
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+import random
+
+ACCOUNTS = ['Assets:Current:Cash at Bank', 'Assets:Current:Cash on Hand', 'Assets:Current:Investments', 'Liabilities:Current:Credit Card', 'Equity:Opening Balances', 'Income:Salary', 'Income:Business:Sales', 'Expenses:Food', 'Expenses:Rent', 'Expenses:Business:Cost of Goods Sold'] + ['Expenses:Category {}'.format(i) for i in range(40)]
+
+def make_ledger(num_transactions, seed=1, start=datetime(2015, 1, 1), days=2000):
+	# Return a Ledger of random two-posting transactions in date order, some in a foreign currency and some in shares held at cost, with prices for both
+	rng = random.Random(seed)
+	ledger = Ledger(None)
+	
+	report_commodity = ledger.intern_commodity(Commodity(config['report_commodity'], True, False))
+	eur = ledger.intern_commodity(Commodity('EUR', False, True))
+	shares = ledger.intern_commodity(Commodity('SHARE', False, True))
+	ledger.commodities = {c.name: c for c in (report_commodity, eur, shares)}
+	# Amounts in other commodities are held at cost
+	eur_lots = [ledger.intern_commodity(Commodity('EUR', False, True, Amount(Decimal(rate), report_commodity))) for rate in ('1.45', '1.52', '1.61')]
+	share_lots = [ledger.intern_commodity(Commodity('SHARE', False, True, Amount(Decimal(price), report_commodity))) for price in ('10.50', '12.25', '9.80')]
+	
+	accounts = [ledger.get_account(name) for name in ACCOUNTS]
+	
+	dates = sorted(start + timedelta(days=rng.randrange(days)) for _ in range(num_transactions))
+	for i, date in enumerate(dates):
+		transaction = Transaction(ledger, str(i + 1), date, 'Payee {}'.format(rng.randrange(500)), '', str(i + 1))
+		
+		kind = rng.random()
+		if kind < 0.9:
+			amount = Amount(Decimal(rng.randrange(1, 100000)) / 100, report_commodity)
+		elif kind < 0.95:
+			amount = Amount(Decimal(rng.randrange(1, 100000)) / 100, rng.choice(eur_lots))
+		else:
+			amount = Amount(Decimal(rng.randrange(1, 100)), rng.choice(share_lots))
+		
+		account_from, account_to = rng.sample(accounts, 2)
+		transaction.postings.append(Posting(transaction, account_to, amount))
+		transaction.postings.append(Posting(transaction, account_from, -amount))
+		ledger.transactions.append(transaction)
+	
+	for day in range(0, days, 7):
+		ledger.prices.append((start + timedelta(days=day), 'EUR', Amount(Decimal('1.5') + Decimal(rng.randrange(-100, 100)) / 1000, report_commodity)))
+		ledger.prices.append((start + timedelta(days=day), 'SHARE', Amount(Decimal('11') + Decimal(rng.randrange(-200, 200)) / 100, report_commodity)))
+	
+	return ledger
@@ -0,0 +1,132 @@
+#   ledger-pyreport
+#   Copyright © 2020  Lee Yingtong Li (RunasSudo)
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Check that trial_balances, computed serially and in forked worker processes, and trial_balance for each period give the same results as trial_balance
+# with the original trial_balance_raw, which summed every posting in turn, then time each
+# Usage: python benchmarks/trial_balances.py [number of random ledgers to check] [number of transactions to time]
+
+import synthetic # Sets up the config, so must be imported first
+
+from datetime import datetime, timedelta
+import multiprocessing
+import random
+import sys
+import time
+
+from ledger_pyreport import accounting
+from ledger_pyreport.config import config
+from ledger_pyreport.model import *
+
+num_checks = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+num_transactions = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+
+modes = [('serial', 0)]
+if 'fork' in multiprocessing.get_all_start_methods():
+	modes.append(('forked', 4))
+
+# Compare by commodity (and price) rather than by Amount, as balances may be built up in a different order
+def balance_key(balance):
+	result = {}
+	for amount in balance.amounts:
+		key = (amount.commodity.name, amount.commodity.price.tostr(False) if amount.commodity.price else None)
+		result[key] = result.get(key, 0) + amount.amount
+	return {key: value for key, value in result.items() if value != 0}
+
+def trial_balance_key(tb):
+	balances = {name: balance_key(balance) for name, balance in tb.balances.items()}
+	transactions = [(t.date, t.description, [(p.account.name, p.amount.tostr(False)) for p in t.postings]) for t in tb.ledger.transactions]
+	return {name: balance for name, balance in balances.items() if balance}, transactions
+
+# The original trial_balance_raw, as a reference for the grouped sums of accounting.trial_balance_raw
+# (except that accumulated OCI was added to the balance of retained earnings)
+def reference_trial_balance_raw(ledger, date, pstart, label=None):
+	tb = TrialBalance(ledger, date, pstart, label=label)
+	
+	for transaction in ledger.transactions:
+		if transaction.date > date:
+			continue
+		
+		for posting in transaction.postings:
+			if (posting.account.is_income or posting.account.is_expense) and transaction.date < pstart:
+				tb.balances[config['retained_earnings']] = tb.get_balance(ledger.get_account(config['retained_earnings'])) + posting.amount
+			elif posting.account.is_oci and transaction.date < pstart:
+				tb.balances[config['accumulated_oci']] = tb.get_balance(ledger.get_account(config['accumulated_oci'])) + posting.amount
+			else:
+				tb.balances[posting.account.name] = tb.get_balance(posting.account) + posting.amount
+	
+	return tb
+
+def reference_trial_balance(ledger, date, pstart, commodity, label=None):
+	grouped_trial_balance_raw = accounting.trial_balance_raw
+	accounting.trial_balance_raw = reference_trial_balance_raw
+	try:
+		return accounting.trial_balance(ledger, date, pstart, commodity, label)
+	finally:
+		accounting.trial_balance_raw = grouped_trial_balance_raw
+
+def random_periods(rng):
+	periods = []
+	for i in range(rng.randint(1, 6)):
+		date = datetime(2015, 3, 1) + timedelta(days=rng.randrange(2000))
+		pstart = date - timedelta(days=rng.choice([0, 1, 30, 200, 365, -1]))
+		periods.append((date, pstart, str(i)))
+	return periods
+
+# Equivalence on random ledgers and periods
+rng = random.Random(11)
+for check in range(num_checks):
+	ledger = synthetic.make_ledger(rng.randrange(10, 2000), seed=check)
+	report_commodity = ledger.get_commodity(config['report_commodity'])
+	periods = random_periods(rng)
+	
+	expected = [trial_balance_key(reference_trial_balance(ledger.clone(), date, pstart, report_commodity, label)) for date, pstart, label in periods]
+	
+	actual = [trial_balance_key(accounting.trial_balance(ledger.clone(), date, pstart, report_commodity, label)) for date, pstart, label in periods]
+	if actual != expected:
+		print('Ledger {}: trial_balance differs from the reference for periods {}'.format(check, periods))
+		sys.exit(1)
+	
+	for mode, processes in modes:
+		config['period_processes'] = processes
+		actual = [trial_balance_key(tb) for tb in accounting.trial_balances(ledger, periods, report_commodity)]
+		if actual != expected:
+			print('Ledger {}, {}: trial_balances differs from the reference for periods {}'.format(check, mode, periods))
+			sys.exit(1)
+
+print('{} random ledgers: trial_balance and trial_balances ({}) match the reference'.format(num_checks, ', '.join(mode for mode, _ in modes)))
+
+# Timing of a comparative report of 5 years
+ledger = synthetic.make_ledger(num_transactions)
+report_commodity = ledger.get_commodity(config['report_commodity'])
+periods = [(datetime(2020 - i, 6, 30), datetime(2019 - i, 7, 1), str(2020 - i)) for i in range(5)]
+
+print('{} transactions, {} periods'.format(num_transactions, len(periods)))
+
+start = time.perf_counter()
+for date, pstart, label in periods:
+	reference_trial_balance(ledger.clone(), date, pstart, report_commodity, label)
+print('reference per period: {:.2f} s'.format(time.perf_counter() - start))
+
+start = time.perf_counter()
+for date, pstart, label in periods:
+	accounting.trial_balance(ledger.clone(), date, pstart, report_commodity, label)
+print('trial_balance per period: {:.2f} s'.format(time.perf_counter() - start))
+
+for mode, processes in modes:
+	config['period_processes'] = processes
+	start = time.perf_counter()
+	accounting.trial_balances(ledger, periods, report_commodity)
+	print('trial_balances ({}): {:.2f} s'.format(mode, time.perf_counter() - start))
@@ -15,16 +15,23 @@
 #   along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 # Extension to move pending postings to a pending transactions account
+# The transactions are shared with the cached ledger, so transactions with pending postings are replaced rather than modified
 
 _ledger_raw_transactions_at_date = ledger.raw_transactions_at_date
 def ledger_raw_transactions_at_date(*args, **kwargs):
 	l = _ledger_raw_transactions_at_date(*args, **kwargs)
 	
+	transactions = []
 	for transaction in l.transactions:
-		for posting in transaction.postings:
-			if posting.state == Posting.State.PENDING:
-				posting.account = l.get_account('Liabilities:Current:Pending Transactions')
+		if any(p.state == Posting.State.PENDING for p in transaction.postings):
+			result = Transaction(l, transaction.id, transaction.date, transaction.description, transaction.code, transaction.uuid, transaction.metadata)
+			for posting in transaction.postings:
+				account = l.get_account('Liabilities:Current:Pending Transactions') if posting.state == Posting.State.PENDING else posting.account
+				result.postings.append(Posting(result, account, posting.amount, posting.comment, posting.state))
+			transaction = result
+		transactions.append(transaction)
 	
+	l.transactions = transactions
 	return l
 
 ledger.raw_transactions_at_date = ledger_raw_transactions_at_date
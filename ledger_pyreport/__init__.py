@@ -19,15 +19,293 @@ from . import ledger
 from .config import config
 from .model import *
 
+import bisect
 import calendar
-from datetime import datetime, timedelta
+import collections
+import concurrent.futures
+import csv
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 from markupsafe import Markup
 import flask
+import functools
+import glob
+import hashlib
+import io
 import itertools
+import json
+import os
+import re
+import threading
+import time
 
 app = flask.Flask(__name__, template_folder='jinja2')
 
+# Cache of rendered reports, keyed on the request and the state of the journal
+
+_report_cache = collections.OrderedDict() # ETag -> (mimetype, body)
+_report_cache_lock = threading.Lock()
+
+def app_digest():
+	# Reports also depend on the configuration, templates and code, so a change to any of these must change the ETag
+	digest = hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode('utf-8'))
+	paths = glob.glob(os.path.join(app.root_path, '*.py')) + glob.glob(os.path.join(app.root_path, app.template_folder, '*')) + config.get('extensions', [])
+	for path in sorted(paths):
+		try:
+			digest.update('{}:{}'.format(path, os.stat(path).st_mtime_ns).encode('utf-8'))
+		except OSError:
+			pass
+	return digest.digest()
+
+_app_digest = app_digest()
+_app_started = time.time() # Changes to the configuration, templates and code take effect only on restart
+
+def report_etag(fingerprint):
+	digest = hashlib.sha256(_app_digest)
+	digest.update(repr((flask.request.path, sorted(flask.request.args.items(multi=True)), export_format(), fingerprint)).encode('utf-8'))
+	return digest.hexdigest()
+
+def report_last_modified(fingerprint):
+	# Reports also depend on the configuration, templates and code (as the ETag does), so are modified no earlier than when they were loaded
+	mtimes = [mtime / 1e9 for _, mtime, _ in fingerprint[0] if mtime is not None]
+	return datetime.fromtimestamp(max(mtimes + [_app_started]), timezone.utc)
+
+RE_MIMETYPE = re.compile(rb'[a-z0-9.+-]+/[a-z0-9.+-]+\n')
+
+def report_cache_path(etag):
+	cache_dir = config.get('report_cache_dir')
+	return os.path.join(cache_dir, etag + '.report') if cache_dir else None
+
+def get_cached_report(etag):
+	with _report_cache_lock:
+		if etag in _report_cache:
+			_report_cache.move_to_end(etag)
+			return _report_cache[etag]
+	
+	path = report_cache_path(etag)
+	if not path:
+		return None
+	
+	# Stored as the mimetype on the first line, followed by the body
+	try:
+		with open(path, 'rb') as f:
+			mimetype = f.readline()
+			body = f.read()
+		# Record the access for LRU eviction
+		os.utime(path)
+	except OSError:
+		return None
+	
+	if not RE_MIMETYPE.fullmatch(mimetype):
+		# Not written by put_cached_report
+		return None
+	entry = (mimetype[:-1].decode('ascii'), body)
+	
+	put_cached_report(etag, entry, False)
+	return entry
+
+def put_cached_report(etag, entry, to_disk=True):
+	with _report_cache_lock:
+		_report_cache[etag] = entry
+		_report_cache.move_to_end(etag)
+		while len(_report_cache) > config.get('report_cache_size', 64):
+			_report_cache.popitem(last=False)
+	
+	path = report_cache_path(etag)
+	if not path or not to_disk:
+		return
+	
+	# Write to a temporary file first so that readers never see a partial report
+	tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+	with open(tmp_path, 'wb') as f:
+		f.write(entry[0].encode('ascii') + b'\n')
+		f.write(entry[1])
+	os.replace(tmp_path, path)
+	
+	# Evict the least recently used reports
+	paths = glob.glob(os.path.join(config['report_cache_dir'], '*.report'))
+	if len(paths) > config.get('report_cache_disk_size', 1024):
+		mtimes = []
+		for p in paths:
+			try:
+				mtimes.append((os.stat(p).st_mtime, p))
+			except OSError:
+				pass
+		mtimes.sort()
+		for _, p in mtimes[:len(mtimes) - config.get('report_cache_disk_size', 1024)]:
+			try:
+				os.unlink(p)
+			except OSError:
+				pass
+
+def cached_report(view):
+	# Serve the report from the cache if the journal has not changed since it was rendered, and answer conditional GETs without touching the ledger
+	@functools.wraps(view)
+	def wrapper(*args, **kwargs):
+		if not config.get('report_cache_size', 64):
+			return view(*args, **kwargs)
+		
+		_, fingerprint = ledger.journal_state()
+		etag = report_etag(fingerprint)
+		last_modified = report_last_modified(fingerprint)
+		
+		def report_response(mimetype=None, body=b''):
+			response = flask.Response(body, mimetype=mimetype)
+			response.set_etag(etag)
+			response.last_modified = last_modified
+			# The journal may change at any time, so clients must revalidate
+			response.cache_control.no_cache = True
+			response.vary.add('Accept')
+			return response
+		
+		response = report_response().make_conditional(flask.request)
+		if response.status_code == 304:
+			return response
+		
+		entry = get_cached_report(etag)
+		if entry is None:
+			response = flask.make_response(view(*args, **kwargs))
+			if response.status_code != 200 or response.is_streamed:
+				return response
+			if ledger.journal_state()[1] != fingerprint:
+				# Changed while rendering, so it is unknown which version was rendered
+				return response
+			
+			entry = (response.mimetype, response.get_data())
+			put_cached_report(etag, entry)
+		
+		return report_response(*entry)
+	
+	return wrapper
+
+# Machine-readable export of reports, without rendering templates
+
+EXPORT_FORMATS = {'jsonl': 'application/x-ndjson', 'csv': 'text/csv'}
+EXPORT_COLUMNS = ['period', 'date_beg', 'date_end', 'line', 'account', 'balance', 'total', 'commodity']
+
+def export_format():
+	# Return the format requested by ?format= or else the Accept header, or None for HTML
+	fmt = flask.request.args.get('format', None)
+	if fmt:
+		if fmt == 'html':
+			return None
+		if fmt not in EXPORT_FORMATS:
+			flask.abort(400)
+		return fmt
+	
+	best = flask.request.accept_mimetypes.best_match(['text/html'] + list(EXPORT_FORMATS.values()))
+	return next((f for f, mimetype in EXPORT_FORMATS.items() if mimetype == best), None)
+
+def export_row(tb, line, account, balance, total=None):
+	# Amounts are in the report commodity, positive for debits and negative for credits
+	return {
+		'period': tb.label or '',
+		'date_beg': tb.pstart.strftime('%Y-%m-%d'),
+		'date_end': tb.date.strftime('%Y-%m-%d'),
+		'line': line,
+		'account': account.name if account else '',
+		'balance': str(balance.amount),
+		'total': str(total.amount) if total is not None else '',
+		'commodity': balance.commodity.name,
+	}
+
+def export_rows(tbs, accounts, report_commodity, line='account'):
+	for tb in tbs:
+		for account in accounts:
+			yield export_row(tb, line, account, tb.get_balance_exchanged(account, report_commodity), tb.get_total_exchanged(account, report_commodity))
+
+def export_tree(root, accounts):
+	# Return the account and its descendants which appear in a statement, in the order they appear, as the templates walk the account tree
+	result = [root] if root in accounts else []
+	for child in sorted(root.children, key=lambda a: a.name):
+		if child in accounts:
+			result.extend(export_tree(child, accounts))
+	return result
+
+def export_sections(tbs, sections, report_commodity):
+	# sections is a list of (line, accounts), exported in turn for each period
+	for tb in tbs:
+		for line, accounts in sections:
+			yield from export_rows([tb], accounts, report_commodity, line)
+
+def export_trial_accounts(trial_balances, accounts, report_commodity):
+	# Include accounts with balances but no transactions (e.g. current year earnings), so the exported trial balance balances
+	return [a for a in accounts if any(a in tb.trn_accounts or not tb.get_balance_exchanged(a, report_commodity).near_zero for tb in trial_balances)]
+
+def export_response(fmt, rows):
+	# Stream the rows as JSON lines or CSV, as they are computed
+	def generate():
+		if fmt == 'csv':
+			output = io.StringIO()
+			writer = csv.DictWriter(output, EXPORT_COLUMNS)
+			writer.writeheader()
+			for row in rows:
+				writer.writerow(row)
+				yield output.getvalue()
+				output.seek(0)
+				output.truncate()
+			yield output.getvalue()
+		else:
+			for row in rows:
+				yield json.dumps(row) + '\n'
+	
+	return flask.Response(flask.stream_with_context(generate()), mimetype=EXPORT_FORMATS[fmt])
+
+# Background pre-warming of the report cache after the journal changes
+
+# The reports linked from the index page, with its default values, as submitted by the browser
+PREWARM_REPORTS = [
+	'/trial?date={date}&pstart={pstart}&compare=0&cmpperiod=year',
+	'/balance?date={date}&pstart={pstart}&compare=0&cmpperiod=year',
+	'/pandl?date_beg={pstart}&date_end={date}&compare=0&cmpperiod=year&scope=pandl',
+]
+
+_prewarm_started = False
+_prewarm_lock = threading.Lock()
+
+def prewarm_urls():
+	date = datetime.now()
+	values = {'date': date.strftime('%Y-%m-%d'), 'pstart': ledger.financial_year(date).strftime('%Y-%m-%d')}
+	return [url.format(**values) for url in PREWARM_REPORTS + config.get('prewarm_reports', [])]
+
+def prewarm_report(url):
+	# Call the report's view for the URL, so the report is cached exactly as if requested
+	with app.test_request_context(url):
+		if flask.request.routing_exception is not None:
+			raise flask.request.routing_exception
+		app.view_functions[flask.request.url_rule.endpoint](**flask.request.view_args)
+
+def prewarm_worker():
+	# Renders at most prewarm_threads reports at once, so interactive requests are not starved
+	pool = concurrent.futures.ThreadPoolExecutor(max_workers=config.get('prewarm_threads', 0), thread_name_prefix='prewarm')
+	last_state = None
+	
+	while True:
+		# The default reports also change with the date
+		generation, fingerprint = ledger.journal_state()
+		state = (fingerprint, datetime.now().date())
+		if state != last_state:
+			last_state = state
+			try:
+				ledger.get_ledger()
+				list(pool.map(prewarm_report, prewarm_urls()))
+			except Exception:
+				app.logger.exception('Error pre-warming reports')
+		
+		ledger.wait_for_journal(generation, config.get('prewarm_interval', 60))
+
+@app.before_request
+def start_prewarm():
+	global _prewarm_started
+	
+	if _prewarm_started or not config.get('prewarm_threads', 0) or not config.get('report_cache_size', 64):
+		return
+	
+	with _prewarm_lock:
+		if not _prewarm_started:
+			_prewarm_started = True
+			threading.Thread(target=prewarm_worker, name='prewarm', daemon=True).start()
+
 @app.route('/')
 def index():
 	date = datetime.now()
@@ -81,7 +359,14 @@ def describe_period(date_end, date_beg):
 	else:
 		return 'period from {} to {}'.format(date_beg.strftime('%d %B %Y'), date_end.strftime('%d %B %Y'))
 
+def request_account(l, name):
+	# Look up an account named in the request without creating it, as the account tree is shared with the cached ledger
+	if name not in l.accounts:
+		flask.abort(404)
+	return l.accounts[name]
+
 @app.route('/trial')
+@cached_report
 def trial():
 	date = datetime.strptime(flask.request.args['date'], '%Y-%m-%d')
 	pstart = datetime.strptime(flask.request.args['pstart'], '%Y-%m-%d')
@@ -100,9 +385,9 @@ def trial():
 		total_dr = Amount(0, report_commodity)
 		total_cr = Amount(0, report_commodity)
 
-		for account in l.accounts.values():
+		for account in list(l.accounts.values()):
 			# Display in "cost basis" as we have already accounted for unrealised gains
-			balance = trial_balance.get_balance(account).exchange(report_commodity, True)
+			balance = trial_balance.get_balance_exchanged(account, report_commodity)
 			if balance > 0:
 				total_dr += balance
 			else:
@@ -110,7 +395,11 @@ def trial():
 
 		# Identify which accounts have transactions
 		accounts = sorted(l.accounts.values(), key=lambda a: a.name)
-		trial_balance.trn_accounts = [a for a in accounts if any(p.account == a for t in l.transactions for p in t.postings if t.date >= pstart and t.date <= date)]
+		trial_balance.trn_accounts = [a for a in accounts if l.account_postings(a, pstart, date)]
+
+		fmt = export_format()
+		if fmt:
+			return export_response(fmt, export_rows([trial_balance], export_trial_accounts([trial_balance], accounts, report_commodity), report_commodity))
 
 		return flask.render_template('trial.html', date=date, pstart=pstart, trial_balance=trial_balance, accounts=accounts, total_dr=total_dr, total_cr=total_cr, report_commodity=report_commodity)
 	else:
@@ -121,12 +410,16 @@ def trial():
 		report_commodity = l.get_commodity(config['report_commodity'])
 		if cash:
 			l = accounting.ledger_to_cash(l, report_commodity)
-		trial_balances = [accounting.trial_balance(l.clone(), d, p, report_commodity, label=lbl) for d, p, lbl in zip(dates, pstarts, labels)]
+		trial_balances = accounting.trial_balances(l, zip(dates, pstarts, labels), report_commodity)
 
 		# Identify which accounts have transactions in which periods
 		accounts = sorted(l.accounts.values(), key=lambda a: a.name)
 		for trial_balance in trial_balances:
-			trial_balance.trn_accounts = [a for a in accounts if any(p.account == a for t in l.transactions for p in t.postings if t.date >= trial_balance.pstart and t.date <= trial_balance.date)]
+			trial_balance.trn_accounts = [a for a in accounts if l.account_postings(a, trial_balance.pstart, trial_balance.date)]
+
+		fmt = export_format()
+		if fmt:
+			return export_response(fmt, export_rows(trial_balances, export_trial_accounts(trial_balances, accounts, report_commodity), report_commodity))
 
 		# Delete accounts with always no transactions
 		for account in accounts[:]:
@@ -136,6 +429,7 @@ def trial():
 		return flask.render_template('trial_multiple.html', trial_balances=trial_balances, accounts=accounts, report_commodity=report_commodity, cash=cash)
 
 @app.route('/balance')
+@cached_report
 def balance():
 	date = datetime.strptime(flask.request.args['date'], '%Y-%m-%d')
 	pstart = datetime.strptime(flask.request.args['pstart'], '%Y-%m-%d')
@@ -149,17 +443,24 @@ def balance():
 	report_commodity = l.get_commodity(config['report_commodity'])
 	if cash:
 		l = accounting.ledger_to_cash(l, report_commodity)
-	balance_sheets = [accounting.balance_sheet(accounting.trial_balance(l.clone(), d, p, report_commodity, label=lbl)) for d, p, lbl in zip(dates, pstarts, labels)]
+	balance_sheets = [accounting.balance_sheet(tb) for tb in accounting.trial_balances(l, zip(dates, pstarts, labels), report_commodity)]
 
 	# Delete accounts with always zero balances
 	accounts = list(l.accounts.values())
 	for account in accounts[:]:
-		if all(b.get_balance(account).exchange(report_commodity, True).near_zero and b.get_total(account).exchange(report_commodity, True).near_zero for b in balance_sheets):
+		if all(b.get_balance_exchanged(account, report_commodity).near_zero and b.get_total_exchanged(account, report_commodity).near_zero for b in balance_sheets):
 			accounts.remove(account)
 
+	fmt = export_format()
+	if fmt:
+		# Only the accounts which appear on the balance sheet
+		sections = [('account', export_tree(l.get_account(config[name]), accounts)) for name in ('assets_account', 'liabilities_account', 'equity_account')]
+		return export_response(fmt, export_sections(balance_sheets, sections, report_commodity))
+
 	return flask.render_template('balance.html', ledger=l, balance_sheets=balance_sheets, accounts=accounts, config=config, report_commodity=report_commodity, cash=cash)
 
 @app.route('/pandl')
+@cached_report
 def pandl():
 	date_beg = datetime.strptime(flask.request.args['date_beg'], '%Y-%m-%d')
 	date_end = datetime.strptime(flask.request.args['date_end'], '%Y-%m-%d')
@@ -174,7 +475,9 @@ def pandl():
 	report_commodity = l.get_commodity(config['report_commodity'])
 	if cash:
 		l = accounting.ledger_to_cash(l, report_commodity)
-	pandls = [accounting.trial_balance(l.clone(), de, db, report_commodity, label=lbl) for de, db, lbl in zip(dates_end, dates_beg, labels)]
+	# Separate P&L accounts are unlinked from their parents below, which must not affect concurrent requests sharing the cached ledger
+	l.detach_accounts()
+	pandls = accounting.trial_balances(l, zip(dates_end, dates_beg, labels), report_commodity)
 
 	# Process separate P&L accounts
 	separate_pandls = []
@@ -186,6 +489,8 @@ def pandl():
 		# Unlink from parents so raw figures not counted in income/expense total
 		acc_income.parent.children.remove(acc_income)
 		acc_expenses.parent.children.remove(acc_expenses)
+		for p in pandls:
+			p.invalidate()
 
 		# Add summary account
 		for i, de, db in zip(range(compare + 1), dates_end, dates_beg):
@@ -204,9 +509,23 @@ def pandl():
 		if all(p.get_balance(account) == 0 and p.get_total(account) == 0 for p in pandls):
 			accounts.remove(account)
 
+	fmt = export_format()
+	if fmt:
+		# Only the accounts which appear on the income statement for the scope
+		# Separate P&L accounts are given as separate_pandl lines, as their profit or loss is already included in the income or expenses accounts
+		sections = []
+		if scope != 'oci':
+			for acc_income, acc_expenses in separate_pandls:
+				sections.append(('separate_pandl', export_tree(acc_income, accounts) + export_tree(acc_expenses, accounts)))
+			sections.append(('account', export_tree(l.get_account(config['income_account']), accounts) + export_tree(l.get_account(config['expenses_account']), accounts)))
+		if scope != 'pandl':
+			sections.append(('account', export_tree(l.get_account(config['oci_account']), accounts)))
+		return export_response(fmt, export_sections(pandls, sections, report_commodity))
+
 	return flask.render_template('pandl.html', period=describe_period(date_end, date_beg), ledger=l, pandls=pandls, accounts=accounts, separate_pandls=separate_pandls, config=config, report_commodity=report_commodity, cash=cash, scope=scope)
 
 @app.route('/cashflow')
+@cached_report
 def cashflow():
 	date_beg = datetime.strptime(flask.request.args['date_beg'], '%Y-%m-%d')
 	date_end = datetime.strptime(flask.request.args['date_end'], '%Y-%m-%d')
@@ -219,18 +538,17 @@ def cashflow():
 	l = ledger.raw_transactions_at_date(date_end)
 	report_commodity = l.get_commodity(config['report_commodity'])
 
-	cash_accounts = [a for a in l.accounts.values() if a.is_cash]
+	cash_accounts = [a for a in list(l.accounts.values()) if a.is_cash]
 
 	# Calculate opening and closing cash
 	opening_balances = []
 	closing_balances = []
 	cashflows = []
 	profits = []
-	for de, db, lbl in zip(dates_end, dates_beg, labels):
-		tb = accounting.trial_balance(l.clone(), db - timedelta(days=1), db, report_commodity)
-		opening_balances.append(sum((tb.get_balance(a) for a in cash_accounts), Balance()).exchange(report_commodity, True))
+	tbs = accounting.trial_balances(l, [(db - timedelta(days=1), db, None) for db in dates_beg] + [(de, db, None) for de, db in zip(dates_end, dates_beg)], report_commodity)
+	for de, db, lbl, tb_opening, tb in zip(dates_end, dates_beg, labels, tbs[:len(labels)], tbs[len(labels):]):
+		opening_balances.append(sum((tb_opening.get_balance(a) for a in cash_accounts), Balance()).exchange(report_commodity, True))
 
-		tb = accounting.trial_balance(l.clone(), de, db, report_commodity)
 		closing_balances.append(sum((tb.get_balance(a) for a in cash_accounts), Balance()).exchange(report_commodity, True))
 
 		if method == 'direct':
@@ -241,7 +559,7 @@ def cashflow():
 			profits.append(-(tb.get_total(tb.ledger.get_account(config['income_account'])) + tb.get_total(tb.ledger.get_account(config['expenses_account'])) + tb.get_total(tb.ledger.get_account(config['oci_account']))).exchange(report_commodity, True))
 
 			# Determine transactions affecting equity, liabilities and non-cash assets
-			noncash_accounts = [a for a in l.accounts.values() if a.is_equity or a.is_liability or (a.is_asset and not a.is_cash)]
+			noncash_accounts = [a for a in list(l.accounts.values()) if a.is_equity or a.is_liability or (a.is_asset and not a.is_cash)]
 			cashflows.append(accounting.account_flows(tb.ledger, de, db, noncash_accounts, False, label=lbl))
 
 	# Delete accounts with always zero balances
@@ -250,12 +568,81 @@ def cashflow():
 		if all(p.get_balance(account) == 0 and p.get_total(account) == 0 for p in cashflows):
 			accounts.remove(account)
 
+	fmt = export_format()
+	if fmt:
+		def rows():
+			for i, cashflow in enumerate(cashflows):
+				yield export_row(cashflow, 'opening_cash', None, opening_balances[i])
+				if profits:
+					yield export_row(cashflow, 'net_profit', None, profits[i])
+				yield from export_rows([cashflow], sorted(accounts, key=lambda a: a.name), report_commodity)
+				yield export_row(cashflow, 'closing_cash', None, closing_balances[i])
+
+		return export_response(fmt, rows())
+
 	if method == 'direct':
 		return flask.render_template('cashflow_direct.html', period=describe_period(date_end, date_beg), ledger=l, cashflows=cashflows, opening_balances=opening_balances, closing_balances=closing_balances, accounts=accounts, config=config, report_commodity=report_commodity)
 	else:
 		return flask.render_template('cashflow_indirect.html', period=describe_period(date_end, date_beg), ledger=l, cashflows=cashflows, profits=profits, opening_balances=opening_balances, closing_balances=closing_balances, accounts=accounts, config=config, report_commodity=report_commodity)
 
+class RunningTotals:
+	# Totals of the debits and credits of transactions, accumulated as the transactions are rendered, so a streamed report needs no separate pass to compute them
+
+	def __init__(self, report_commodity):
+		self.report_commodity = report_commodity
+		self._dr = MutableBalance()
+		self._cr = MutableBalance()
+
+	def add(self, transaction):
+		for posting in transaction.postings:
+			if posting.amount > 0:
+				self._dr += posting.amount
+			elif posting.amount < 0:
+				self._cr += posting.amount
+
+	def iterate(self, transactions):
+		for transaction in transactions:
+			self.add(transaction)
+			yield transaction
+
+	@property
+	def dr(self):
+		return self._dr.to_balance().exchange(self.report_commodity, True)
+
+	@property
+	def cr(self):
+		return self._cr.to_balance().exchange(self.report_commodity, True)
+
+def stream_template(template_name, **context):
+	# Send the report as it is rendered, so the browser can begin displaying a large report before it is complete
+	app.update_template_context(context)
+	stream = app.jinja_env.get_template(template_name).stream(context)
+	stream.enable_buffering(100)
+	return flask.Response(flask.stream_with_context(stream))
+
+# Identify a transaction in the general ledger by its date and position among the transactions on that date
+# Unlike the UUID, this is given for every transaction, including those for unrealized gains
+def page_cursor(transactions, index):
+	date = transactions[index].date
+	position = index - bisect.bisect_left([t.date for t in transactions], date, hi=index)
+	return '{:%Y-%m-%d}.{}'.format(date, position)
+
+# Return the index of the transaction following the one identified by the cursor
+def page_cursor_index(transactions, cursor):
+	try:
+		date_str, position = cursor.split('.')
+		date = datetime.strptime(date_str, '%Y-%m-%d')
+		position = int(position)
+	except ValueError:
+		flask.abort(404)
+
+	index = bisect.bisect_left([t.date for t in transactions], date) + position
+	if position < 0 or index >= len(transactions) or transactions[index].date != date:
+		flask.abort(404)
+	return index + 1
+
 @app.route('/transactions')
+@cached_report
 def transactions():
 	date_beg = datetime.strptime(flask.request.args['date_beg'], '%Y-%m-%d')
 	date_end = datetime.strptime(flask.request.args['date_end'], '%Y-%m-%d')
@@ -274,16 +661,38 @@ def transactions():
 
 	if not account:
 		# General Ledger
-		transactions = [t for t in l.transactions if t.date <= date_end and t.date >= date_beg]
+		transactions = l.transactions_between(date_beg, date_end)
+		totals = RunningTotals(report_commodity)
+
+		# Optionally split into pages, each continuing after the last transaction of the previous page
+		try:
+			page_size = int(flask.request.args.get('page_size', config.get('general_ledger_page_size', 0)))
+		except ValueError:
+			flask.abort(400)
+		next_url = None
+		if page_size > 0:
+			start = 0
+			after = flask.request.args.get('after')
+			if after:
+				start = page_cursor_index(transactions, after)
+
+			if start + page_size < len(transactions):
+				next_url = flask.url_for('transactions', **dict(flask.request.args, after=page_cursor(transactions, start + page_size - 1)))
+			else:
+				# Only the last page shows the totals, which include the earlier pages
+				for transaction in transactions[:start]:
+					totals.add(transaction)
 
-		total_dr = sum((p.amount for t in transactions for p in t.postings if p.amount > 0), Balance()).exchange(report_commodity, True)
-		total_cr = sum((p.amount for t in transactions for p in t.postings if p.amount < 0), Balance()).exchange(report_commodity, True)
+			transactions = transactions[start:start + page_size]
 
-		return flask.render_template('transactions.html', date_beg=date_beg, date_end=date_end, period=describe_period(date_end, date_beg), account=None, ledger=l, transactions=transactions, total_dr=total_dr, total_cr=total_cr, report_commodity=report_commodity, cash=cash)
+		context = dict(date_beg=date_beg, date_end=date_end, period=describe_period(date_end, date_beg), account=None, ledger=l, transactions=totals.iterate(transactions), totals=totals, next_url=next_url, report_commodity=report_commodity, cash=cash)
+		if config.get('stream_general_ledger', True):
+			return stream_template('transactions.html', **context)
+		return flask.render_template('transactions.html', **context)
 	elif commodity:
 		# Account Transactions with commodity detail
-		account = l.get_account(account)
-		transactions = [t for t in l.transactions if t.date <= date_end and t.date >= date_beg and any(p.account == account for p in t.postings)]
+		account = request_account(l, account)
+		transactions = l.account_transactions(account, date_beg, date_end)
 
 		# Use trial_balance_raw because ledger is already adjusted for unrealised gains, etc.
 		opening_balance = accounting.trial_balance_raw(l, date_beg - timedelta(days=1), date_beg).get_balance(account).clean()
@@ -295,8 +704,8 @@ def transactions():
 		return flask.render_template('transactions_commodity.html', date_beg=date_beg, date_end=date_end, period=describe_period(date_end, date_beg), account=account, ledger=l, transactions=transactions, opening_balance=opening_balance, closing_balance=closing_balance, report_commodity=report_commodity, cash=cash, timedelta=timedelta, matching_posting=matching_posting)
 	else:
 		# Account Transactions
-		account = l.get_account(account)
-		transactions = [t.perspective_of(account) for t in l.transactions if t.date <= date_end and t.date >= date_beg and any(p.account == account for p in t.postings)]
+		account = request_account(l, account)
+		transactions = [t.perspective_of(account) for t in l.account_transactions(account, date_beg, date_end)]
 
 		opening_balance = accounting.trial_balance_raw(l, date_beg - timedelta(days=1), date_beg).get_balance(account).exchange(report_commodity, True)
 		closing_balance = accounting.trial_balance_raw(l, date_end, date_beg).get_balance(account).exchange(report_commodity, True)
@@ -304,6 +713,7 @@ def transactions():
 		return flask.render_template('transactions.html', date_beg=date_beg, date_end=date_end, period=describe_period(date_end, date_beg), account=account, ledger=l, transactions=transactions, opening_balance=opening_balance, closing_balance=closing_balance, report_commodity=report_commodity, cash=cash, timedelta=timedelta)
 
 @app.route('/transaction')
+@cached_report
 def transaction():
 	date = datetime.strptime(flask.request.args['date'], '%Y-%m-%d')
 	pstart = datetime.strptime(flask.request.args['pstart'], '%Y-%m-%d')
@@ -396,6 +806,13 @@ def filter_commodity_table_positive(amt, show_price, link=None):
 
 	return Markup(''.join(result))
 
+# Command line interface
+
+@app.cli.command('snapshot')
+def snapshot_command():
+	"""Parse the journal and write the ledger snapshot file."""
+	ledger.save_snapshot(ledger.parse_ledger())
+
 # Debug views
 
 @app.route('/debug/imbalances')
@@ -409,12 +826,10 @@ def debug_imbalances():
 	if cash:
 		l = accounting.ledger_to_cash(l, report_commodity)
 
-	transactions = [t for t in l.transactions if t.date <= date and t.date >= pstart and not sum((p.amount for p in t.postings), Balance()).exchange(report_commodity, True).near_zero]
-
-	total_dr = sum((p.amount for t in transactions for p in t.postings if p.amount > 0), Balance()).exchange(report_commodity, True)
-	total_cr = sum((p.amount for t in transactions for p in t.postings if p.amount < 0), Balance()).exchange(report_commodity, True)
+	transactions = [t for t in l.transactions_between(pstart, date) if not sum((p.amount for p in t.postings), Balance()).exchange(report_commodity, True).near_zero]
+	totals = RunningTotals(report_commodity)
 
-	return flask.render_template('transactions.html', date=date, pstart=pstart, period=describe_period(date, pstart), account=None, ledger=l, transactions=transactions, total_dr=total_dr, total_cr=total_cr, report_commodity=report_commodity, cash=cash)
+	return flask.render_template('transactions.html', date=date, pstart=pstart, period=describe_period(date, pstart), account=None, ledger=l, transactions=totals.iterate(transactions), totals=totals, report_commodity=report_commodity, cash=cash)
 
 # Load extensions
 for ext_name in config['extensions']:
@@ -14,10 +14,14 @@
 #   You should have received a copy of the GNU Affero General Public License
 #   along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import csv
 from datetime import timedelta
 from decimal import Decimal
+import functools
+import itertools
 import math
+import multiprocessing
 
 from .model import *
 
@@ -26,26 +30,206 @@ from .model import *
 def trial_balance_raw(ledger, date, pstart, label=None):
 	tb = TrialBalance(ledger, date, pstart, label=label)
 	
-	for transaction in ledger.transactions:
-		if transaction.date > date:
-			continue
+	accounts = list(ledger.accounts.values())
+	closed_accounts = [a for a in accounts if a.is_income or a.is_expense or a.is_oci]
+	other_accounts = [a for a in accounts if not (a.is_income or a.is_expense or a.is_oci)]
+	
+	for account, balance in ledger.account_balances(None, date, other_accounts).items():
+		tb.balances[account.name] = balance
+	for account, balance in ledger.account_balances(pstart, date, closed_accounts).items():
+		tb.balances[account.name] = balance
+	
+	# Close income, expenses and OCI before the period start
+	retained_earnings = MutableBalance()
+	accumulated_oci = MutableBalance()
+	closed_pandl = closed_oci = False
+	
+	for account, balance in ledger.account_balances(None, min(date, pstart - timedelta(days=1)), closed_accounts).items():
+		if account.is_income or account.is_expense:
+			retained_earnings += balance
+			closed_pandl = True
+		else:
+			accumulated_oci += balance
+			closed_oci = True
+	
+	if closed_pandl:
+		tb.balances[config['retained_earnings']] = tb.get_balance(ledger.get_account(config['retained_earnings'])) + retained_earnings.to_balance()
+	if closed_oci:
+		tb.balances[config['accumulated_oci']] = tb.get_balance(ledger.get_account(config['accumulated_oci'])) + accumulated_oci.to_balance()
+	
+	return tb
+
+# Return the account to which a posting is recorded, closing income, expenses and OCI before the period start
+def _closing_account(ledger, account, date, pstart):
+	if (account.is_income or account.is_expense) and date < pstart:
+		return ledger.get_account(config['retained_earnings'])
+	if account.is_oci and date < pstart:
+		return ledger.get_account(config['accumulated_oci'])
+	return account
+
+# Generate trial balances for several (date, pstart) periods in a single pass over the ledger
+# Equivalent to calling trial_balance_raw for each period
+def trial_balances_raw(ledger, periods, labels=None):
+	periods = list(periods)
+	labels = labels or [None] * len(periods)
+	
+	# Record cumulative balances before each period start (False), and after each date (True)
+	checkpoints = sorted(set([(pstart, False) for date, pstart in periods] + [(date, True) for date, pstart in periods]))
+	snapshots = {}
+	
+	transactions = sorted(ledger.transactions, key=lambda t: t.date)
+	running = {} # Account -> MutableBalance
+	frozen = {} # Account -> Balance as at the last checkpoint
+	i = 0
+	
+	for checkpoint, inclusive in checkpoints:
+		changed = {}
+		while i < len(transactions) and (transactions[i].date <= checkpoint if inclusive else transactions[i].date < checkpoint):
+			for posting in transactions[i].postings:
+				balance = running.get(posting.account)
+				if balance is None:
+					balance = running[posting.account] = MutableBalance()
+				balance += posting.amount
+				changed[posting.account] = balance
+			i += 1
 		
-		for posting in transaction.postings:
-			if (posting.account.is_income or posting.account.is_expense) and transaction.date < pstart:
-				tb.balances[config['retained_earnings']] = tb.get_balance(ledger.get_account(config['retained_earnings'])) + posting.amount
-			elif posting.account.is_oci and transaction.date < pstart:
-				tb.balances[config['accumulated_oci']] = tb.get_balance(ledger.get_account(config['retained_earnings'])) + posting.amount
+		# Accounts without postings since the last checkpoint keep the same Balance
+		for account, balance in changed.items():
+			frozen[account] = balance.to_balance()
+		snapshots[(checkpoint, inclusive)] = dict(frozen)
+	
+	results = []
+	for (date, pstart), label in zip(periods, labels):
+		closing = snapshots[(date, True)]
+		opening = snapshots[(pstart, False)] if pstart <= date else closing
+		
+		tb = TrialBalance(ledger, date, pstart, label=label)
+		closed_pandl = []
+		closed_oci = []
+		
+		for account, balance in closing.items():
+			if account.is_income or account.is_expense:
+				closed = closed_pandl
+			elif account.is_oci:
+				closed = closed_oci
 			else:
-				tb.balances[posting.account.name] = tb.get_balance(posting.account) + posting.amount
+				tb.balances[account.name] = balance
+				continue
+			
+			opening_balance = opening.get(account)
+			if opening_balance is None:
+				tb.balances[account.name] = balance
+				continue
+			
+			closed.append(opening_balance)
+			if balance is not opening_balance:
+				# Account has postings within the period
+				tb.balances[account.name] = (balance - opening_balance).clean()
+		
+		if closed_pandl:
+			tb.balances[config['retained_earnings']] = sum(closed_pandl, tb.get_balance(ledger.get_account(config['retained_earnings'])))
+		if closed_oci:
+			tb.balances[config['accumulated_oci']] = sum(closed_oci, tb.get_balance(ledger.get_account(config['accumulated_oci'])))
+		
+		results.append(tb)
 	
-	return tb
+	return results
 
 # Trial balance with unrealized gains and OCI
 def trial_balance(ledger, date, pstart, commodity, label=None):
 	tb_date, r_date = _add_unrealized_gains(trial_balance_raw(ledger, date, pstart, label=label), commodity)
 	tb_pstart, r_pstart = _add_unrealized_gains(trial_balance_raw(ledger, pstart - timedelta(days=1), pstart), commodity)
 	
-	for account in set(list(r_date.keys()) + list(r_pstart.keys())):
+	return _reverse_unrealized_gains(tb_date, r_date, r_pstart)
+
+# Trial balances with unrealized gains and OCI for several (date, pstart, label) periods
+# Equivalent to calling trial_balance for each period on a clone of the ledger
+def trial_balances(ledger, periods, commodity):
+	periods = list(periods)
+	
+	raw_periods = [(date, pstart) for date, pstart, label in periods] + [(pstart - timedelta(days=1), pstart) for date, pstart, label in periods]
+	raw_labels = [label for date, pstart, label in periods] + [None] * len(periods)
+	raw_tbs = trial_balances_raw(ledger, raw_periods, raw_labels)
+	
+	processes = min(config.get('period_processes', 0), len(periods))
+	if processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+		return _trial_balances_forked(ledger, raw_tbs, commodity, processes)
+	
+	return [_period_trial_balance(ledger, tb_date, tb_pstart, commodity) for tb_date, tb_pstart in zip(raw_tbs[:len(periods)], raw_tbs[len(periods):])]
+
+# Complete the raw trial balances for one period with unrealized gains, on a clone of the ledger
+def _period_trial_balance(ledger, tb_date, tb_pstart, commodity):
+	tb_date.ledger = tb_pstart.ledger = ledger.clone()
+	
+	tb_date, r_date = _add_unrealized_gains(tb_date, commodity)
+	
+	# As in trial_balance, unrealized gains dated before the period start fall within the opening trial balance
+	for trn in [t for transactions in r_date.values() for t in transactions]:
+		if trn.date <= tb_pstart.date:
+			for posting in trn.postings:
+				account = _closing_account(tb_pstart.ledger, posting.account, trn.date, tb_pstart.pstart)
+				tb_pstart.balances[account.name] = tb_pstart.get_balance(account) + posting.amount
+	
+	tb_pstart, r_pstart = _add_unrealized_gains(tb_pstart, commodity)
+	
+	return _reverse_unrealized_gains(tb_date, r_date, r_pstart)
+
+# State for worker processes, inherited through fork so that the ledger is shared copy-on-write rather than pickled per task
+# Keyed by job, so that comparative reports in different threads need not wait for each other
+_forked_jobs = {}
+_forked_job_ids = itertools.count()
+
+def _trial_balances_forked(ledger, raw_tbs, commodity, processes):
+	num_periods = len(raw_tbs) // 2
+	
+	# The workers are forked for each report, so that they see this version of the ledger
+	# Only locks of this package are held across fork; see period_processes in config.example.yml
+	job = next(_forked_job_ids)
+	_forked_jobs[job] = (ledger, raw_tbs, commodity)
+	try:
+		with concurrent.futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork')) as executor:
+			results = list(executor.map(functools.partial(_forked_period, job), range(num_periods)))
+	finally:
+		del _forked_jobs[job]
+	
+	# Rebuild each period's ledger and trial balance from what the worker changed
+	tbs = []
+	for tb, (balances, added) in zip(raw_tbs, results):
+		tb.ledger = ledger.clone()
+		
+		for at_start, trn_id, date, description, code, uuid, metadata, postings in added:
+			transaction = Transaction(tb.ledger, trn_id, date, description, code, uuid, metadata)
+			for account_name, amount, comment, state in postings:
+				transaction.postings.append(Posting(transaction, tb.ledger.get_account(account_name), _intern_amount(tb.ledger, amount), comment, state))
+			tb.ledger.add_transaction(transaction, at_start)
+		
+		tb.balances = {name: Balance([_intern_amount(tb.ledger, a) for a in balance.amounts]) for name, balance in balances.items()}
+		tbs.append(tb)
+	
+	return tbs
+
+def _intern_amount(ledger, amount):
+	return Amount(amount.amount, ledger.intern_commodity(amount.commodity))
+
+def _forked_period(job, i):
+	# Runs in a worker process: return the period's balances, and the transactions added to its ledger
+	ledger, raw_tbs, commodity = _forked_jobs[job]
+	num_periods = len(raw_tbs) // 2
+	
+	tb = _period_trial_balance(ledger, raw_tbs[i], raw_tbs[num_periods + i], commodity)
+	
+	# Return names rather than Accounts and Transactions, which would drag the whole ledger along when pickled
+	added = [(at_start, t.id, t.date, t.description, t.code, t.uuid, t.metadata, [(p.account.name, p.amount, p.comment, p.state) for p in t.postings]) for t, at_start in tb.ledger.added]
+	
+	return dict(tb.balances), added
+
+# Adjust (in place) a trial balance to reverse unrealized gains of the previous period
+def _reverse_unrealized_gains(tb_date, r_date, r_pstart):
+	ledger = tb_date.ledger
+	pstart = tb_date.pstart
+	
+	# In order of name, so the reversals are added in the same order in every process
+	for account in sorted(set(list(r_date.keys()) + list(r_pstart.keys())), key=lambda a: a.name):
 		if account in r_pstart:
 			for trn in r_pstart[account]:
 				# Update/accumulate trial balances
@@ -60,7 +244,7 @@ def trial_balance(ledger, date, pstart, commodity, label=None):
 				
 				# Reversing entry
 				trn_reversal = trn.reverse(None, pstart, '<Reversal of {}>'.format(trn.description[1:-1]))
-				ledger.transactions.insert(0, trn_reversal)
+				ledger.add_transaction(trn_reversal, at_start=True)
 				
 				tb_date.balances[account.name] = tb_date.get_balance(account) + trn_reversal.postings[0].amount
 				tb_date.balances[trn_reversal.postings[1].account.name] = tb_date.get_balance(trn_reversal.postings[1].account) - trn_reversal.postings[0].amount
@@ -79,7 +263,8 @@ def _add_unrealized_gains(tb, commodity):
 	unrealized_gain_account = tb.ledger.get_account(config['unrealized_gains'][0])
 	unrealized_loss_account = tb.ledger.get_account(config['unrealized_gains'][1])
 	
-	for account in list(tb.ledger.accounts.values()):
+	# In order of name, so the transactions are added in the same order however the accounts were created
+	for account in sorted(tb.ledger.accounts.values(), key=lambda a: a.name):
 		if not account.is_market:
 			continue
 		
@@ -100,7 +285,7 @@ def _add_unrealized_gains(tb, commodity):
 			transaction = Transaction(tb.ledger, None, tb.date, '<Unrealized Gains>')
 			transaction.postings.append(Posting(transaction, account, unrealized_gain))
 			transaction.postings.append(Posting(transaction, unrealized_gain_account, -unrealized_gain))
-			tb.ledger.transactions.append(transaction)
+			tb.ledger.add_transaction(transaction)
 			
 			results[account] = results.get(account, []) + [transaction]
 		
@@ -108,7 +293,7 @@ def _add_unrealized_gains(tb, commodity):
 			transaction = Transaction(tb.ledger, None, tb.date, '<Unrealized Losses>')
 			transaction.postings.append(Posting(transaction, account, unrealized_loss))
 			transaction.postings.append(Posting(transaction, unrealized_loss_account, -unrealized_loss))
-			tb.ledger.transactions.append(transaction)
+			tb.ledger.add_transaction(transaction)
 			
 			results[account] = results.get(account, []) + [transaction]
 	
@@ -144,15 +329,23 @@ def ledger_to_cash(ledger, commodity):
 
 # Summarise related transactions
 def account_flows(ledger, date, pstart, accounts, related, label=None):
-	transactions = [t for t in ledger.transactions if any(p.account in accounts for p in t.postings) and t.date <= date and t.date >= pstart]
+	accounts = set(accounts)
+	related_transactions = set(t for account in accounts for t in ledger.account_transactions(account, pstart, date))
+	transactions = [t for t in ledger.transactions_between(pstart, date) if t in related_transactions]
 	
 	tb = TrialBalance(ledger, date, pstart, label=label)
+	balances = {}
 	
 	for transaction in transactions:
 		for posting in transaction.postings:
 			if (posting.account in accounts) is related:
 				continue
 			
-			tb.balances[posting.account.name] = tb.get_balance(posting.account) - posting.amount
+			balance = balances.get(posting.account.name)
+			if balance is None:
+				balance = balances[posting.account.name] = MutableBalance()
+			balance -= posting.amount
+	
+	tb.balances = {name: balance.to_balance() for name, balance in balances.items()}
 	
 	return tb
@@ -17,29 +17,104 @@
 from .config import config
 from .model import *
 
+import array
+import collections
+import concurrent.futures
 import csv
+import ctypes
+import ctypes.util
 from datetime import datetime, timedelta
 from decimal import Decimal
+import errno
+import functools
+import gc
+import glob
 import hashlib
+import io
+import itertools
+import json
+import logging
+import os
 import re
+import select
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree
 
 # Helper commands to run Ledger
 
-def run_ledger(*args):
-	ledger_args = ['ledger', '--args-only', '--file', config['ledger_file'], '--date-format', '%Y-%m-%d', '--unround'] + config['ledger_args'] + list(args)
-	proc = subprocess.Popen(ledger_args, encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	stdout, stderr = proc.communicate()
+def ledger_command(*args, file=None):
+	return ['ledger', '--args-only', '--file', file or config['ledger_file'], '--date-format', '%Y-%m-%d', '--unround'] + config['ledger_args'] + list(args)
+
+# Limit the number of Ledger processes running at once across all requests, so a burst of requests cannot overload the host
+ledger_slots = threading.BoundedSemaphore(config.get('ledger_concurrency', 4))
+
+# Pool for running Ledger in the background, e.g. to run independent commands concurrently
+ledger_pool = concurrent.futures.ThreadPoolExecutor(max_workers=config.get('ledger_concurrency', 4), thread_name_prefix='ledger')
+
+def ledger_timeout_error():
+	return Exception('Ledger did not finish within {} seconds'.format(config['ledger_timeout']))
+
+def run_ledger(*args, file=None):
+	with ledger_slots:
+		proc = subprocess.Popen(ledger_command(*args, file=file), encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		try:
+			stdout, stderr = proc.communicate(timeout=config.get('ledger_timeout'))
+		except subprocess.TimeoutExpired:
+			proc.kill()
+			proc.communicate()
+			raise ledger_timeout_error()
 	
 	if stderr:
 		raise Exception(stderr)
 	
 	return stdout
 
-def run_ledger_date(date, *args):
+def run_ledger_stream(*args, file=None):
+	# Like run_ledger, but yield the output line by line as Ledger produces it
+	# stderr is spooled to a temporary file so that Ledger cannot block on a full pipe
+	with ledger_slots, tempfile.TemporaryFile('w+', encoding='utf-8') as stderr_file:
+		proc = subprocess.Popen(ledger_command(*args, file=file), encoding='utf-8', stdout=subprocess.PIPE, stderr=stderr_file)
+		
+		# The output is read as it is consumed, so enforce the timeout by killing Ledger
+		timed_out = threading.Event()
+		timer = None
+		if config.get('ledger_timeout'):
+			timer = threading.Timer(config['ledger_timeout'], lambda: (timed_out.set(), proc.kill()))
+			timer.start()
+		
+		try:
+			yield from proc.stdout
+		except BaseException:
+			# Consumer stopped early or failed
+			proc.kill()
+			raise
+		finally:
+			proc.stdout.close()
+			proc.wait()
+			if timer:
+				timer.cancel()
+		
+		if timed_out.is_set() and proc.returncode != 0:
+			raise ledger_timeout_error()
+		
+		stderr_file.seek(0)
+		stderr = stderr_file.read()
+	
+	if stderr:
+		raise Exception(stderr)
+
+def date_args(date):
 	if date is None:
-		return run_ledger(*args)
-	return run_ledger('--end', (date + timedelta(days=1)).strftime('%Y-%m-%d'), *args)
+		return []
+	return ['--end', (date + timedelta(days=1)).strftime('%Y-%m-%d')]
+
+def run_ledger_date(date, *args):
+	return run_ledger(*date_args(date), *args)
 
 # General financial logic
 
@@ -56,60 +131,81 @@ csv.register_dialect('ledger', doublequote=False, escapechar='\\', strict=True)
 RE_COMMODITY1 = re.compile(r'([0123456789.,-]+)( *)(.+)')
 RE_COMMODITY2 = re.compile(r'(.+?)( *)([0123456789.,-]+)')
 
-def parse_amount(amount):
-	if '{' in amount:
-		amount_str = amount[:amount.index('{')].strip()
-		price_str = amount[amount.index('{')+1:amount.index('}')].strip()
+def parse_amount(amount, ledger=None):
+	# If ledger is given, the commodity is interned in that ledger
+	amount_num, commodity = parse_amount_cached(amount)
+	
+	if ledger is not None:
+		commodity = ledger.intern_commodity(commodity)
+	
+	return Amount(amount_num, commodity)
+
+@functools.lru_cache(maxsize=65536)
+def parse_amount_cached(amount):
+	# Return (number, Commodity) for the amount string
+	# Cached as the same amounts and commodities recur throughout a journal; the results are shared, so must not be modified
+	brace = amount.find('{')
+	if brace >= 0:
+		price = Amount(*parse_amount_cached(amount[brace+1:amount.index('}', brace)].strip()))
+		amount = amount[:brace].strip()
 	else:
-		amount_str = amount
-		price_str = None
+		price = None
 	
-	if amount_str[0] in list('0123456789-'):
+	if amount[0] in '0123456789-':
 		# Commodity follows number
-		result = RE_COMMODITY1.match(amount_str)
-		amount_num = Decimal(result.group(1).replace(',', ''))
-		commodity = Commodity(result.group(3).strip('"'), False, len(result.group(2)) > 0)
+		result = RE_COMMODITY1.match(amount)
+		return Decimal(result.group(1).replace(',', '')), Commodity(result.group(3).strip('"'), False, len(result.group(2)) > 0, price)
 	else:
 		# Commodity precedes number
-		result = RE_COMMODITY2.match(amount_str)
-		amount_num = Decimal(result.group(3).replace(',', ''))
-		commodity = Commodity(result.group(1).strip('"'), True, len(result.group(2)) > 0)
-	
-	if price_str:
-		commodity.price = parse_amount(price_str)
-	
-	return Amount(amount_num, commodity)
+		result = RE_COMMODITY2.match(amount)
+		return Decimal(result.group(3).replace(',', '')), Commodity(result.group(1).strip('"'), True, len(result.group(2)) > 0, price)
 
-def get_pricedb():
-	output = run_ledger('prices', '--prices-format', '%(quoted(format_date(date))),%(quoted(display_account)),%(quoted(display_amount))\n')
-	
+PRICES_FORMAT = '%(quoted(format_date(date))),%(quoted(display_account)),%(quoted(display_amount))\n'
+
+def get_pricedb(ledger=None, file=None):
+	return parse_pricedb(run_ledger_stream('prices', '--prices-format', PRICES_FORMAT, file=file), ledger)
+
+def submit_pricedb(file=None):
+	# Start running Ledger to get the price database in the background; pass the result to parse_pricedb
+	return ledger_pool.submit(lambda: io.StringIO(run_ledger('prices', '--prices-format', PRICES_FORMAT, file=file)))
+
+def parse_pricedb(output, ledger=None):
 	prices = []
 	
-	reader = csv.reader(output.splitlines(), dialect='ledger')
+	reader = csv.reader(output, dialect='ledger')
 	for date_str, commodity, price_str in reader:
-		prices.append((datetime.strptime(date_str, '%Y-%m-%d'), commodity.strip('"'), parse_amount(price_str)))
+		prices.append((datetime.strptime(date_str, '%Y-%m-%d'), commodity.strip('"'), parse_amount(price_str, ledger)))
 	
 	return prices
 
-def raw_transactions_at_date(date):
-	ledger = Ledger(date)
-	ledger.prices = get_pricedb()
-	
-	output = run_ledger_date(date, 'csv', '--csv-format', '%(quoted(parent.id)),%(quoted(format_date(date))),%(quoted(parent.code)),%(quoted(payee)),%(quoted(account)),%(quoted(display_amount)),%(quoted(comment)),%(quoted(state)),%(quoted(note))\n')
-	
-	uuids = set()
-	
-	reader = csv.reader(output.splitlines(True), dialect='ledger')
-	for trn_id, date_str, code, payee, account_str, amount_str, comment, state_str, note_str in reader:
-		if not ledger.transactions or trn_id != ledger.transactions[-1].id:
-			if trn_id in uuids:
-				digest = hashlib.sha256()
-				digest.update(trn_id.encode('utf-8'))
-				digest.update(date_str.encode('utf-8'))
-				digest.update(payee.encode('utf-8'))
-				uuid = digest.hexdigest()
-			else:
-				uuid = trn_id
+def transaction_uuid(trn_id, date_str, payee, uuids):
+	# Return a UUID for the transaction, distinguishing transactions with the same ID, and add it to uuids
+	if trn_id in uuids:
+		digest = hashlib.sha256()
+		digest.update(trn_id.encode('utf-8'))
+		digest.update(date_str.encode('utf-8'))
+		digest.update(payee.encode('utf-8'))
+		uuid = digest.hexdigest()
+	else:
+		uuid = trn_id
+	
+	uuids.add(uuid)
+	return uuid
+
+CSV_FORMAT = '%(quoted(parent.id)),%(quoted(format_date(date))),%(quoted(parent.code)),%(quoted(payee)),%(quoted(account)),%(quoted(display_amount)),%(quoted(comment)),%(quoted(state)),%(quoted(note)),%(quoted(filename))\n'
+
+def parse_csv(ledger, output, uuids):
+	# Parse CSV output from Ledger into a list of (Transaction, path of the file it came from), in the order given
+	# uuids is the set of UUIDs already in use, and is updated with the new transactions
+	result = []
+	transaction = None
+	paths = {}
+	
+	# Rows are parsed as Ledger produces them, without buffering the whole export
+	reader = csv.reader(output, dialect='ledger')
+	for trn_id, date_str, code, payee, account_str, amount_str, comment, state_str, note_str, filename in reader:
+		if transaction is None or trn_id != transaction.id:
+			uuid = transaction_uuid(trn_id, date_str, payee, uuids)
 			
 			metadata = {}
 			for line in note_str.splitlines():
@@ -118,23 +214,842 @@ def raw_transactions_at_date(date):
 					metadata[line.split(': ')[0]] = line.split(': ')[1].strip()
 			
 			transaction = Transaction(ledger, trn_id, datetime.strptime(date_str, '%Y-%m-%d'), payee, code, uuid, metadata)
-			ledger.transactions.append(transaction)
-			
-			uuids.add(uuid)
-		else:
-			# Transaction ID matches: continuation of previous transaction
-			transaction = ledger.transactions[-1]
+			if filename not in paths:
+				paths[filename] = os.path.abspath(filename)
+			result.append((transaction, paths[filename]))
 		
 		if ';' in comment:
 			comment = comment[comment.index(';')+1:].strip()
 		
-		amount = parse_amount(amount_str)
+		amount = parse_amount(amount_str, ledger)
 		posting = Posting(transaction, ledger.get_account(account_str), amount, comment=comment, state=Posting.State(int(state_str)))
 		transaction.postings.append(posting)
 		
 		if amount.commodity.name not in ledger.commodities:
-			ledger.commodities[amount.commodity.name] = amount.commodity.strip_price()
+			ledger.commodities[amount.commodity.name] = ledger.intern_commodity(amount.commodity.strip_price())
+	
+	return result
+
+XML_STATES = {'cleared': Posting.State.CLEARED, 'pending': Posting.State.PENDING}
+
+def parse_xml(ledger, output, uuids):
+	# Parse XML output from Ledger into a list of (Transaction, None), as parse_csv
+	# Amounts, commodities and metadata are given as separate elements, so need not be parsed from formatted text
+	# Ledger does not give the file each transaction came from
+	result = []
+	
+	parser = xml.etree.ElementTree.XMLPullParser(['start', 'end'])
+	parent = None
+	
+	# Elements are parsed as Ledger produces them, and discarded once used
+	for chunk in itertools.chain(output, [None]):
+		if chunk is None:
+			parser.close()
+		else:
+			parser.feed(chunk)
+		
+		for event, element in parser.read_events():
+			if event == 'start':
+				if element.tag in ('accounts', 'transactions'):
+					parent = element
+				continue
+			
+			if element.tag == 'accounts':
+				# Account totals are not needed
+				element.clear()
+			elif element.tag == 'transaction':
+				result.append((xml_transaction(ledger, element, len(result) + 1, uuids), None))
+				if parent is not None:
+					parent.clear()
+	
+	return result
+
+def xml_transaction(ledger, element, seq, uuids):
+	date_str = element.findtext('date')
+	date = datetime(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]))
+	payee = element.findtext('payee', '')
+	
+	metadata = {}
+	for value in element.iterfind('metadata/value'):
+		metadata[value.get('key')] = ''.join(value.itertext()).strip()
+	
+	# Ledger identifies transactions by their UUID tag, or else their position
+	trn_id = metadata.get('UUID', str(seq))
+	uuid = transaction_uuid(trn_id, date.strftime('%Y-%m-%d'), payee, uuids)
+	
+	transaction = Transaction(ledger, trn_id, date, payee, element.findtext('code', ''), uuid, metadata)
+	
+	for posting_element in element.iterfind('postings/posting'):
+		amount = xml_amount(ledger, posting_element.find('post-amount/amount'))
+		posting = Posting(transaction, ledger.get_account(posting_element.findtext('account/name')), amount, comment=posting_element.findtext('note', '').strip(), state=XML_STATES.get(posting_element.get('state'), Posting.State.UNCLEARED))
+		transaction.postings.append(posting)
+		
+		if amount.commodity.name not in ledger.commodities:
+			ledger.commodities[amount.commodity.name] = ledger.intern_commodity(amount.commodity.strip_price())
+	
+	return transaction
+
+def xml_amount(ledger, element):
+	commodity_element = element.find('commodity')
+	if commodity_element is None:
+		commodity = Commodity('', False, False)
+	else:
+		flags = commodity_element.get('flags', '')
+		price_element = commodity_element.find('annotation/price')
+		price = xml_amount(ledger, price_element) if price_element is not None else None
+		commodity = Commodity(commodity_element.findtext('symbol').strip('"'), 'P' in flags, 'S' in flags, price)
+	
+	return Amount(Decimal(element.findtext('quantity')), ledger.intern_commodity(commodity))
+
+def parse_ledger(date=None):
+	ledger = Ledger(date)
+	
+	# Run Ledger for the prices and the transactions concurrently
+	prices = submit_pricedb()
+	
+	if config.get('ledger_backend', 'csv') == 'xml':
+		transactions = parse_xml(ledger, run_ledger_stream(*date_args(date), 'xml'), set())
+	else:
+		transactions = parse_csv(ledger, run_ledger_stream(*date_args(date), 'csv', '--csv-format', CSV_FORMAT), set())
+	
+	for transaction, path in transactions:
+		ledger.transactions.append(transaction)
+		if path:
+			ledger.sources.setdefault(path, []).append(transaction)
 	
 	ledger.transactions.sort(key=lambda t: t.date)
 	
+	ledger.prices = parse_pricedb(prices.result(), ledger)
+	
 	return ledger
+
+# Cache of parsed ledgers, keyed on the state of the journal files
+
+RE_INCLUDE = re.compile(r'^[!@]?include\s+(.+?)\s*$')
+
+_cache = collections.OrderedDict() # Fingerprint -> (time parsed, Ledger, path -> JournalFile)
+_cache_lock = threading.Lock()
+
+_journal_includes = {} # Path -> ((mtime, size), include patterns), so a file is only re-read when it has changed
+
+def journal_includes(path, st):
+	key = (st.st_mtime_ns, st.st_size)
+	cached = _journal_includes.get(path)
+	if cached is not None and cached[0] == key:
+		return cached[1]
+	
+	patterns = []
+	with open(path, 'r', encoding='utf-8', errors='replace') as f:
+		for line in f:
+			match = RE_INCLUDE.match(line)
+			if match:
+				patterns.append(os.path.join(os.path.dirname(path), os.path.expanduser(match.group(1))))
+	
+	_journal_includes[path] = (key, patterns)
+	return patterns
+
+def journal_stats():
+	# Return (path, mtime, size) for the journal file and all files it (transitively) includes, or (path, None, None) if a file cannot be read
+	result = []
+	seen = set()
+	pending = [os.path.abspath(config['ledger_file'])]
+	
+	while pending:
+		path = pending.pop(0)
+		if path in seen:
+			continue
+		seen.add(path)
+		
+		try:
+			st = os.stat(path)
+			patterns = journal_includes(path, st)
+		except OSError:
+			result.append((path, None, None))
+			continue
+		
+		result.append((path, st.st_mtime_ns, st.st_size))
+		for pattern in patterns:
+			pending.extend(sorted(glob.glob(pattern)) or [pattern])
+	
+	return result
+
+def journal_files():
+	# Return the journal file and all files it (transitively) includes
+	return [path for path, _, _ in journal_stats()]
+
+def journal_fingerprint():
+	return (tuple(journal_stats()), tuple(config['ledger_args']))
+
+# Watching the journal for changes, so that requests need not stat every journal file
+
+# inotify(7) flags
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+class JournalWatcher:
+	# Watches the journal and all files it includes, and increments the generation whenever they change
+	# Editors often replace a file rather than write to it, so the directories containing the files are watched
+	
+	def __init__(self, method):
+		self.generation = 0
+		self.fingerprint = None
+		self.changed = threading.Condition()
+		
+		self._libc = None
+		self._fd = None
+		self._watches = {} # Directory -> watch descriptor
+		
+		if method == 'auto':
+			try:
+				self._start_inotify()
+			except (OSError, AttributeError):
+				# Not Linux, or out of inotify instances or watches
+				self._stop_inotify()
+		
+		self._publish(journal_fingerprint())
+		threading.Thread(target=self._run_inotify if self._fd is not None else self._run_poll, name='journal-watcher', daemon=True).start()
+	
+	def _publish(self, fingerprint):
+		with self.changed:
+			if fingerprint != self.fingerprint:
+				self.fingerprint = fingerprint
+				self.generation += 1
+				self.changed.notify_all()
+	
+	def wait(self, generation, timeout=None):
+		# Wait until the generation is no longer the given generation
+		with self.changed:
+			self.changed.wait_for(lambda: self.generation != generation, timeout)
+			return self.generation
+	
+	def _start_inotify(self):
+		self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+		fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+		self._fd = fd
+		self._update_watches()
+	
+	def _stop_inotify(self):
+		if self._fd is not None:
+			os.close(self._fd)
+		self._fd = None
+		self._watches = {}
+	
+	def _update_watches(self):
+		# Includes may have been added or removed, so watch the directories of the files currently included
+		dirs = set(os.path.dirname(path) for path in journal_files())
+		for path in dirs - set(self._watches):
+			wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), IN_WATCH_MASK)
+			if wd < 0:
+				if ctypes.get_errno() == errno.ENOENT:
+					continue
+				raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+			self._watches[path] = wd
+		for path in set(self._watches) - dirs:
+			self._libc.inotify_rm_watch(self._fd, self._watches.pop(path))
+	
+	def _drain(self):
+		try:
+			while os.read(self._fd, 65536):
+				pass
+		except BlockingIOError:
+			pass
+	
+	def _run_inotify(self):
+		debounce = config.get('watch_debounce', 0.2)
+		
+		while True:
+			select.select([self._fd], [], [])
+			self._drain()
+			
+			# Wait for a burst of writes to finish
+			while select.select([self._fd], [], [], debounce)[0]:
+				self._drain()
+			
+			try:
+				self._update_watches()
+			except OSError:
+				# Out of inotify watches
+				self._stop_inotify()
+				self._publish(journal_fingerprint())
+				return self._run_poll()
+			
+			self._publish(journal_fingerprint())
+	
+	def _run_poll(self):
+		debounce = config.get('watch_debounce', 0.2)
+		
+		while True:
+			time.sleep(config.get('watch_interval', 2))
+			
+			fingerprint = journal_fingerprint()
+			if fingerprint == self.fingerprint:
+				continue
+			
+			# Wait for a burst of writes to finish
+			while True:
+				time.sleep(debounce)
+				new_fingerprint = journal_fingerprint()
+				if new_fingerprint == fingerprint:
+					break
+				fingerprint = new_fingerprint
+			
+			self._publish(fingerprint)
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+def journal_watcher():
+	# Return the journal watcher, starting it if necessary, or None if the journal is checked on every request
+	global _watcher
+	
+	method = config.get('journal_watcher', 'auto')
+	if method not in ('auto', 'poll'):
+		return None
+	
+	with _watcher_lock:
+		if _watcher is None:
+			_watcher = JournalWatcher(method)
+		return _watcher
+
+def journal_state():
+	# Return (generation, fingerprint) of the journal as last seen by the watcher, or (None, fingerprint) if not watching
+	watcher = journal_watcher()
+	if watcher is None:
+		return None, journal_fingerprint()
+	
+	with watcher.changed:
+		return watcher.generation, watcher.fingerprint
+
+def wait_for_journal(generation, timeout):
+	# Wait until the journal has changed from the given generation, or the timeout elapses
+	watcher = journal_watcher()
+	if watcher is None or generation is None:
+		time.sleep(timeout)
+	else:
+		watcher.wait(generation, timeout)
+
+# State of each journal file when parsed, used to detect appends and changes confined to one file
+
+JournalFile = collections.namedtuple('JournalFile', ['size', 'digest', 'ends_line', 'is_safe', 'has_aliases', 'has_prices', 'declarations', 'is_tagged'])
+
+RE_DECLARATION = re.compile(r'^(account|commodity|payee|tag)\s')
+RE_ALIAS = re.compile(r'^alias\s')
+RE_UUID_TAG = re.compile(r';\s*UUID:\s*(.*?)\s*$')
+
+def scan_journal(text):
+	# Return (is_safe, has_aliases, has_prices, declarations, uuids) for the journal text
+	# is_safe is False if the text contains anything which could depend on or affect the parsing of other parts of the journal
+	# uuids is the UUID tag of each transaction, in order, or None if it has none (so is identified by its position in the journal)
+	is_safe = True
+	has_aliases = False
+	has_prices = False
+	declarations = []
+	uuids = []
+	
+	in_declaration = False
+	in_header = False # Within the transaction line and comments preceding the first posting, where tags apply to the transaction
+	is_start = True
+	for line in text.splitlines():
+		if is_start and line.strip():
+			is_start = False
+			if line[:1] in (' ', '\t'):
+				# Continues whatever precedes the text, e.g. more postings to the last transaction before an append
+				is_safe = False
+		
+		if line[:1] in (' ', '\t'):
+			if in_declaration:
+				declarations.append(line)
+				continue
+			
+			if in_header and line.lstrip().startswith(';'):
+				match = RE_UUID_TAG.match(line.lstrip())
+				if match:
+					uuids[-1] = match.group(1)
+				continue
+			in_header = False
+			
+			posting = line.split(';')[0]
+			if '=' in posting:
+				# Balance assertion or assignment
+				is_safe = False
+			if '@' in posting or '{' in posting:
+				has_prices = True
+			continue
+		
+		in_declaration = False
+		in_header = False
+		if line[:1].isdigit():
+			match = RE_UUID_TAG.search(line)
+			uuids.append(match.group(1) if match else None)
+			in_header = True
+			continue
+		if not line.strip() or line[0] in ';#%|*' or RE_INCLUDE.match(line):
+			continue
+		if line.startswith('P '):
+			has_prices = True
+		elif RE_DECLARATION.match(line):
+			declarations.append(line)
+			in_declaration = True
+		elif RE_ALIAS.match(line):
+			declarations.append(line)
+			has_aliases = True
+		else:
+			# Automated or periodic transaction, apply, year, default commodity, etc.
+			is_safe = False
+	
+	return is_safe, has_aliases, has_prices, declarations, uuids
+
+def read_journal_file(path):
+	with open(path, 'rb') as f:
+		content = f.read()
+	is_safe, has_aliases, has_prices, declarations, uuids = scan_journal(content.decode('utf-8', errors='replace'))
+	return JournalFile(len(content), hashlib.sha256(content).digest(), content.endswith(b'\n') or not content, is_safe, has_aliases, has_prices, declarations, None not in uuids)
+
+def read_journal_files():
+	# Return path -> JournalFile (or None if unreadable) for the journal and all files it includes
+	result = {}
+	for path in journal_files():
+		try:
+			result[path] = read_journal_file(path)
+		except OSError:
+			result[path] = None
+	return result
+
+# On-disk snapshot of the parsed ledger, a cache for fast cold starts
+# The ledger is still recreated in full in each process; the snapshot only saves running and parsing Ledger
+# It is stored in columns rather than as a pickled object graph, as unpickling millions of small objects is slow, and a snapshot must not be able to run code when loaded:
+# the magic number, then the key and a header of the tables of distinct values (accounts, commodities, strings, etc.) as JSON, each preceded by its length,
+# then arrays of integers per transaction and per posting, indexing into the tables
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_MAGIC = b'LPRSNAP\0'
+SNAPSHOT_LENGTH = struct.Struct('<Q')
+
+def snapshot_key(files=None):
+	# Identify the journal by the content of its files, so a snapshot remains valid when copied between hosts
+	if files is None:
+		files = read_journal_files()
+	
+	digest = hashlib.sha256()
+	for path, file in files.items():
+		digest.update(path.encode('utf-8'))
+		digest.update(file.digest if file else b'\0')
+	return [SNAPSHOT_VERSION, digest.hexdigest(), list(config['ledger_args'])]
+
+def date_seconds(date):
+	return date.toordinal() * 86400 + date.hour * 3600 + date.minute * 60 + date.second
+
+def seconds_date(seconds):
+	return datetime.fromordinal(seconds // 86400) + timedelta(seconds=seconds % 86400)
+
+def snapshot_columns(ledger):
+	# Return (tables, columns) describing the ledger, where columns is a dict of name -> array.array
+	# Distinct values are numbered in the order first seen, with None (or no metadata) as 0
+	strings = {None: 0}
+	accounts = {}
+	commodities = {} # id(Commodity) -> index
+	commodity_defs = []
+	metadata = {None: 0}
+	metadata_defs = [None]
+	sources = {}
+	states = {state: state.value for state in Posting.State}
+	
+	def add_commodity(commodity):
+		index = commodities.get(id(commodity))
+		if index is None:
+			# Commodities are defined after the commodity of their price, so they can be recreated in order
+			price = None
+			if commodity.price is not None:
+				price = (str(commodity.price.amount), add_commodity(commodity.price.commodity))
+			index = commodities[id(commodity)] = len(commodity_defs)
+			commodity_defs.append((commodity.name, commodity.is_prefix, commodity.is_space, price))
+		return index
+	
+	# Accounts and commodities may be added by requests while the snapshot is saved
+	for name in list(ledger.accounts):
+		accounts.setdefault(name, len(accounts))
+	commodity_table = [add_commodity(c) for c in list(ledger._commodity_table.values())]
+	ledger_commodities = [(name, add_commodity(c)) for name, c in list(ledger.commodities.items())]
+	prices = [(date_seconds(date), name, str(amount.amount), add_commodity(amount.commodity)) for date, name, amount in ledger.prices.prices]
+	
+	transaction_source = {}
+	for path, transactions in ledger.sources.items():
+		index = sources.setdefault(path, len(sources))
+		for transaction in transactions:
+			transaction_source[id(transaction)] = index
+	
+	# Each column is a list of integers, made an array once complete
+	trn_date, trn_id, trn_description, trn_code, trn_uuid, trn_metadata, trn_source, trn_postings = [], [], [], [], [], [], [], []
+	pst_account, pst_quantity, pst_commodity, pst_comment, pst_state = [], [], [], [], []
+	
+	for transaction in ledger.transactions:
+		trn_date.append(date_seconds(transaction.date))
+		trn_id.append(strings.setdefault(transaction.id, len(strings)))
+		trn_description.append(strings.setdefault(transaction.description, len(strings)))
+		trn_code.append(strings.setdefault(transaction.code, len(strings)))
+		trn_uuid.append(strings.setdefault(transaction.uuid, len(strings)))
+		if transaction.metadata:
+			key = tuple(transaction.metadata.items())
+			if key not in metadata:
+				metadata[key] = len(metadata_defs)
+				metadata_defs.append(transaction.metadata)
+			trn_metadata.append(metadata[key])
+		else:
+			trn_metadata.append(0)
+		trn_source.append(transaction_source.get(id(transaction), -1))
+		trn_postings.append(len(transaction.postings))
+		
+		for posting in transaction.postings:
+			pst_account.append(accounts.setdefault(posting.account.name, len(accounts)))
+			pst_quantity.append(strings.setdefault(str(posting.amount.amount), len(strings)))
+			pst_commodity.append(add_commodity(posting.amount.commodity))
+			pst_comment.append(strings.setdefault(posting.comment, len(strings)))
+			pst_state.append(states[posting.state])
+	
+	columns = {
+		'trn_date': trn_date,
+		'trn_id': trn_id,
+		'trn_description': trn_description,
+		'trn_code': trn_code,
+		'trn_uuid': trn_uuid,
+		'trn_metadata': trn_metadata,
+		'trn_source': trn_source, # -1 if not known
+		'trn_postings': trn_postings, # Number of postings
+		'pst_account': pst_account,
+		'pst_quantity': pst_quantity,
+		'pst_commodity': pst_commodity,
+		'pst_comment': pst_comment,
+		'pst_state': pst_state,
+	}
+	columns = {name: array.array('q', column) for name, column in columns.items()}
+	
+	tables = {
+		'date': date_seconds(ledger.date) if ledger.date else None,
+		'strings': list(strings),
+		'accounts': list(accounts),
+		'commodities': commodity_defs,
+		'commodity_table': commodity_table,
+		'ledger_commodities': ledger_commodities,
+		'prices': prices,
+		'metadata': [dict(m) if m else None for m in metadata_defs],
+		'sources': list(sources),
+	}
+	return tables, columns
+
+def load_snapshot(files=None):
+	path = config.get('snapshot_file')
+	if not path:
+		return None
+	
+	# The objects created are all kept, so collecting garbage while creating them only wastes time (about half the time taken)
+	gc_enabled = gc.isenabled()
+	gc.disable()
+	try:
+		with open(path, 'rb') as f:
+			if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC or read_snapshot_json(f) != snapshot_key(files):
+				return None
+			header = read_snapshot_json(f)
+			
+			columns = {}
+			for name, count in header['columns']:
+				column = columns[name] = array.array('q')
+				column.fromfile(f, count)
+				if header['byteorder'] != sys.byteorder:
+					column.byteswap()
+		
+		return snapshot_ledger(header['tables'], columns)
+	except (OSError, EOFError, ValueError, KeyError, TypeError, IndexError):
+		# Incomplete, or not written by save_snapshot
+		return None
+	finally:
+		if gc_enabled:
+			gc.enable()
+
+def read_snapshot_json(f):
+	data = f.read(SNAPSHOT_LENGTH.size)
+	if len(data) < SNAPSHOT_LENGTH.size:
+		raise EOFError()
+	length, = SNAPSHOT_LENGTH.unpack(data)
+	if length > os.fstat(f.fileno()).st_size - f.tell():
+		raise EOFError()
+	return json.loads(f.read(length).decode('utf-8'))
+
+def write_snapshot_json(f, value):
+	data = json.dumps(value).encode('utf-8')
+	f.write(SNAPSHOT_LENGTH.pack(len(data)))
+	f.write(data)
+
+def snapshot_ledger(tables, columns):
+	# Recreate the ledger from the tables and columns given by snapshot_columns
+	ledger = Ledger(seconds_date(tables['date']) if tables['date'] is not None else None)
+	strings = tables['strings']
+	
+	# Account types are computed from the current config on creation
+	accounts = [ledger.get_account(name) for name in tables['accounts']]
+	
+	commodities = []
+	for name, is_prefix, is_space, price in tables['commodities']:
+		if price is not None:
+			price = Amount(Decimal(price[0]), commodities[price[1]])
+		commodities.append(Commodity(name, is_prefix, is_space, price))
+	for index in tables['commodity_table']:
+		ledger.intern_commodity(commodities[index])
+	ledger.commodities = {name: commodities[index] for name, index in tables['ledger_commodities']}
+	
+	ledger.prices = [(seconds_date(date), name, Amount(Decimal(quantity), commodities[index])) for date, name, quantity, index in tables['prices']]
+	
+	sources = [[] for _ in tables['sources']]
+	metadata = tables['metadata']
+	states = {state.value: state for state in Posting.State}
+	
+	# Dates and quantities are converted once per distinct value
+	dates = {}
+	quantities = {}
+	
+	transactions = []
+	postings = zip(columns['pst_account'], columns['pst_quantity'], columns['pst_commodity'], columns['pst_comment'], columns['pst_state'])
+	for date, trn_id, description, code, uuid, metadata_index, source, num_postings in zip(columns['trn_date'], columns['trn_id'], columns['trn_description'], columns['trn_code'], columns['trn_uuid'], columns['trn_metadata'], columns['trn_source'], columns['trn_postings']):
+		if date not in dates:
+			dates[date] = seconds_date(date)
+		transaction = Transaction(ledger, strings[trn_id], dates[date], strings[description], strings[code], strings[uuid], dict(metadata[metadata_index]) if metadata_index else None)
+		
+		for account, quantity, commodity, comment, state in itertools.islice(postings, num_postings):
+			if quantity not in quantities:
+				quantities[quantity] = Decimal(strings[quantity])
+			transaction.postings.append(Posting(transaction, accounts[account], Amount(quantities[quantity], commodities[commodity]), strings[comment], states[state]))
+		
+		transactions.append(transaction)
+		if source >= 0:
+			sources[source].append(transaction)
+	
+	ledger.transactions = transactions
+	ledger.sources = {path: sources[i] for i, path in enumerate(tables['sources'])}
+	return ledger
+
+def save_snapshot(ledger, path=None, files=None):
+	path = path or config.get('snapshot_file')
+	if not path:
+		raise Exception('No snapshot_file configured')
+	
+	key = snapshot_key(files)
+	tables, columns = snapshot_columns(ledger)
+	header = {'tables': tables, 'columns': [(name, len(column)) for name, column in columns.items()], 'byteorder': sys.byteorder}
+	
+	# Write to a temporary file first so that readers never see a partial snapshot
+	tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+	with open(tmp_path, 'wb') as f:
+		f.write(SNAPSHOT_MAGIC)
+		write_snapshot_json(f, key)
+		write_snapshot_json(f, header)
+		for column in columns.values():
+			column.tofile(f)
+	os.replace(tmp_path, path)
+
+_snapshot_lock = threading.Lock()
+_snapshot_pending = None # (Ledger, files) waiting to be saved
+_snapshot_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshot')
+
+def save_snapshot_later(ledger, files):
+	# Save the snapshot in the background, so that requests do not wait for it
+	# If the journal changes again before the snapshot is saved, only the latest ledger is saved
+	global _snapshot_pending
+	
+	with _snapshot_lock:
+		is_idle = _snapshot_pending is None
+		_snapshot_pending = (ledger, files)
+	if is_idle:
+		_snapshot_executor.submit(save_pending_snapshot)
+
+def save_pending_snapshot():
+	global _snapshot_pending
+	
+	with _snapshot_lock:
+		ledger, files = _snapshot_pending
+		_snapshot_pending = None
+	
+	try:
+		save_snapshot(ledger, files=files)
+	except Exception:
+		# The snapshot only speeds up the next start, so failing to save it must not affect requests
+		logging.getLogger(__package__).exception('Error saving snapshot')
+
+# Incremental refresh of the cached ledger
+
+def refresh_ledger(key, old_key, old_ledger, old_files):
+	# Bring a cached ledger up to date by parsing only the new part of the journal, if the change is an append to one file, or confined to one included file
+	# Returns (Ledger, files), or None if the journal must be parsed in full
+	if old_files is None or key[1] != old_key[1]:
+		return None
+	
+	stats, old_stats = key[0], old_key[0]
+	if [s[0] for s in stats] != [s[0] for s in old_stats]:
+		return None
+	changed = [i for i in range(len(stats)) if stats[i] != old_stats[i]]
+	if len(changed) != 1 or None in old_files.values() or not all(f.is_safe for f in old_files.values()):
+		return None
+	
+	path = stats[changed[0]][0]
+	old_file = old_files[path]
+	
+	try:
+		with open(path, 'rb') as f:
+			content = f.read()
+	except OSError:
+		return None
+	
+	digest = hashlib.sha256(content).digest()
+	if len(content) == old_file.size and digest == old_file.digest:
+		# Only the modification time has changed
+		return old_ledger, old_files
+	
+	try:
+		if len(content) > old_file.size and old_file.ends_line and hashlib.sha256(content[:old_file.size]).digest() == old_file.digest:
+			# Appended to: parse only the new text
+			is_append = True
+			text = content[old_file.size:].decode('utf-8')
+		elif changed[0] != 0:
+			# Included file changed: parse the whole file, replacing the transactions previously parsed from it
+			is_append = False
+			text = content.decode('utf-8')
+		else:
+			return None
+	except UnicodeDecodeError:
+		return None
+	
+	is_safe, has_aliases, has_prices, declarations, tags = scan_journal(text)
+	if not is_safe:
+		return None
+	
+	# Ledger identifies a transaction without a UUID tag by its position, which differs when parsed apart from the rest of the journal
+	if None in tags:
+		return None
+	# A change to an included file may also move the transactions following it, so the rest of the journal must not rely on position either
+	if changed[0] != 0 and not all(f.is_tagged for p, f in old_files.items() if p != path):
+		return None
+	
+	files = dict(old_files)
+	if is_append:
+		# Aliases apply from where they are defined, so can only be relied upon for an append to the end of the main journal file
+		if changed[0] != 0 and (has_aliases or any(f.has_aliases for f in old_files.values())):
+			return None
+		files[path] = JournalFile(len(content), digest, content.endswith(b'\n'), True, old_file.has_aliases or has_aliases, old_file.has_prices or has_prices, old_file.declarations + declarations, old_file.is_tagged)
+	else:
+		# Prices cannot be attributed to files, so cannot be replaced
+		if path not in old_ledger.sources or has_aliases or has_prices or old_file.has_prices or any(f.has_aliases for f in old_files.values()):
+			return None
+		files[path] = JournalFile(len(content), digest, content.endswith(b'\n'), True, False, False, declarations, True)
+	
+	# Parse the new text in a journal of its own, preceded by the declarations from the rest of the journal
+	preamble = [line for p, f in old_files.items() if is_append or p != path for line in f.declarations]
+	
+	with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.journal', delete=False) as f:
+		f.write('\n'.join(preamble) + '\n' + text)
+	try:
+		ledger = old_ledger.copy()
+		ledger.sources = dict(old_ledger.sources)
+		
+		removed = set()
+		if not is_append:
+			removed = set(ledger.sources.pop(path))
+			ledger.transactions = [t for t in ledger.transactions if t not in removed]
+		
+		prices = submit_pricedb(file=f.name) if has_prices else None
+		
+		uuids = set(t.uuid for t in ledger.transactions)
+		ids = set(t.id for t in ledger.transactions)
+		transactions = [t for t, _ in parse_csv(ledger, run_ledger_stream('csv', '--csv-format', CSV_FORMAT, file=f.name), uuids)]
+		
+		if prices:
+			ledger.prices = list(ledger.prices) + parse_pricedb(prices.result(), ledger)
+	except Exception:
+		# E.g. the new text refers to something defined elsewhere which is not a declaration
+		return None
+	finally:
+		os.unlink(f.name)
+	
+	# Check that Ledger identified the transactions by the tags found, and that none shares an ID with another transaction (or did before)
+	# A shared ID gives the UUID of whichever comes later in the journal a hash, which depends on the order of the full parse
+	new_ids = [t.id for t in transactions]
+	if sorted(new_ids) != sorted(tags) or len(set(new_ids)) != len(new_ids) or not ids.isdisjoint(new_ids) or not ids.isdisjoint(t.id for t in removed):
+		return None
+	
+	if changed[0] != 0:
+		# Transactions on the same date are in the order of the journal, which is known only relative to the transactions of the same file
+		own = set(ledger.sources.get(path, []))
+		for transaction in transactions:
+			if any(t not in own for t in ledger.transactions_between(transaction.date, transaction.date)):
+				return None
+	
+	for transaction in transactions:
+		ledger.add_transaction(transaction)
+	if ledger.sources:
+		# Not recorded if the journal was parsed without file names, else a later replacement would miss the earlier transactions
+		ledger.sources[path] = ledger.sources.get(path, []) + transactions
+	
+	return ledger, files
+
+def get_ledger():
+	# Return the fully parsed ledger, parsing the journal only if it has changed
+	_, key = journal_state()
+	incremental = config.get('incremental_refresh', True)
+	
+	with _cache_lock:
+		now = time.monotonic()
+		
+		for k, (parsed_at, _, _) in list(_cache.items()):
+			if now - parsed_at > config.get('cache_max_age', 3600):
+				del _cache[k]
+		
+		if key in _cache:
+			_cache.move_to_end(key)
+			return _cache[key][1]
+		
+		ledger = None
+		to_save = None
+		if incremental and _cache:
+			old_key, (parsed_at, old_ledger, old_files) = next(reversed(_cache.items()))
+			refreshed = refresh_ledger(key, old_key, old_ledger, old_files)
+			if refreshed:
+				ledger, files = refreshed
+				if config.get('snapshot_file') and ledger is not old_ledger:
+					to_save = ledger
+		
+		if ledger is None:
+			parsed_at = now
+			# The snapshot is keyed on the files as read before parsing
+			files = read_journal_files() if incremental or config.get('snapshot_file') else None
+			ledger = load_snapshot(files)
+			if ledger is None:
+				ledger = parse_ledger()
+				if config.get('snapshot_file'):
+					to_save = ledger
+			
+			if journal_fingerprint() != key:
+				# Changed while parsing, so it is unknown which version was parsed
+				files = None
+				to_save = None
+		
+		# Keep the time of the last full parse, so that cache_max_age still forces a full parse
+		_cache[key] = (parsed_at, ledger, files)
+		
+		while len(_cache) > config.get('cache_size', 2):
+			_cache.popitem(last=False)
+	
+	# Saved outside the lock, as saving takes a while and other requests need not wait for it
+	if to_save is not None:
+		save_snapshot_later(to_save, files)
+	
+	return ledger
+
+def raw_transactions_at_date(date):
+	return get_ledger().at_date(date)
@@ -16,11 +16,23 @@
 
 from .config import config
 
+import bisect
 from decimal import Decimal
 from enum import Enum
 import functools
+import heapq
 import itertools
 import math
+import os
+import threading
+
+_account_lock = threading.RLock()
+_price_lock = threading.Lock()
+
+# Worker processes may be forked (see period_processes) while another thread holds a lock, so hold them across fork, as the logging module does
+if hasattr(os, 'register_at_fork'):
+	for lock in (_account_lock, _price_lock):
+		os.register_at_fork(before=lock.acquire, after_in_parent=lock.release, after_in_child=lock.release)
 
 class Ledger:
 	def __init__(self, date):
@@ -28,17 +40,227 @@ class Ledger:
 		
 		self.root_account = Account(self, '')
 		self.accounts = {}
+		self._account_table = self.accounts # All accounts in the account tree, which may be more than those of a view of the ledger
 		self.transactions = []
 		
 		self.commodities = {}
+		self._commodity_table = {}
 		self.prices = []
+		
+		self.sources = {} # Path of journal file -> transactions parsed from it
 	
 	def clone(self):
+		# Return a view of this ledger to which transactions can be added without affecting this ledger
+		return LedgerOverlay(self)
+	
+	def copy(self):
+		# Return an independent copy of this ledger, sharing accounts, commodities and prices
 		result = Ledger(self.date)
 		result.root_account = self.root_account
 		result.accounts = self.accounts
+		result._account_table = self._account_table
+		result.commodities = self.commodities
+		result._commodity_table = self._commodity_table
 		result.transactions = self.transactions[:]
+		dates = self._get_dates()
+		if dates:
+			result._dates = dates[:]
+			if self._account_index is not None:
+				result._account_index = dict(self._account_index) # Entries are copied on write
+			result._index_base = self._index_base
+			result._index_date = self._index_date
+		elif dates is False:
+			result._dates = False
+			result._unsorted_count = self._unsorted_count
 		result.prices = self.prices
+		result.sources = self.sources
+		return result
+	
+	def at_date(self, date):
+		# Return a view of this ledger limited to transactions up to and including the date
+		# The account tree, commodities and prices are shared with this ledger, but only accounts and commodities of transactions up to the date are listed,
+		# as if the journal were parsed to the date (along with accounts in no transaction, e.g. those added by reports)
+		# Transactions and postings are also shared, so must not be modified (extensions should replace them instead)
+		result = Ledger(date)
+		result.root_account = self.root_account
+		result._account_table = self._account_table
+		result._commodity_table = self._commodity_table
+		result.prices = self.prices
+		
+		if date is None:
+			result.accounts = dict(self.accounts)
+			result.commodities = dict(self.commodities)
+		else:
+			account_dates, commodity_dates = self._get_first_dates()
+			result.accounts = {name: account for name, account in list(self.accounts.items()) if account_dates.get(account, date) <= date}
+			result.commodities = {name: commodity for name, commodity in list(self.commodities.items()) if commodity_dates.get(name, date) <= date}
+		
+		result.transactions = self.transactions_between(None, date)
+		dates = self._get_dates()
+		if dates:
+			result._dates = dates[:len(result.transactions)]
+			# Share the account index of this ledger, limited to the date, rather than build one for each view
+			result._index_base = self._index_base or self
+			result._index_date = date
+			if self._index_date is not None and (date is None or self._index_date < date):
+				result._index_date = self._index_date
+		
+		return result
+	
+	@property
+	def transactions(self):
+		return self._transactions
+	
+	@transactions.setter
+	def transactions(self, transactions):
+		self._transactions = transactions
+		self._dates = None
+		self._account_index = None
+		self._first_dates = None
+		self._index_base = None # Ledger whose account index is shared, with entries after _index_date ignored
+		self._index_date = None
+	
+	def _get_dates(self):
+		# Return the sorted list of transaction dates, or None if the transactions are not in date order
+		# Rebuilt if the transactions have been added to other than through add_transaction
+		if self._dates is False:
+			# Transactions out of order stay out of order until more are added, so need not be checked again until then
+			if self._unsorted_count == len(self._transactions):
+				return False
+		elif self._dates is not None and len(self._dates) == len(self._transactions):
+			return self._dates
+		
+		dates = [t.date for t in self._transactions]
+		if all(dates[i] <= dates[i + 1] for i in range(len(dates) - 1)):
+			self._dates = dates
+		else:
+			self._dates = False
+			self._unsorted_count = len(dates)
+		self._account_index = None
+		self._first_dates = None
+		self._index_base = None
+		self._index_date = None
+		return self._dates
+	
+	def _get_first_dates(self):
+		# Return dicts of Account -> date of the first posting to it or its descendants, and commodity name -> date of the first posting in it
+		self._get_dates() # Forgets the dates if the transactions have changed
+		if self._first_dates is None:
+			account_dates = {}
+			commodity_dates = {}
+			for transaction in self._transactions:
+				for posting in transaction.postings:
+					# An account is never first used after its descendants, so its ancestors need not be checked once it is not updated
+					account = posting.account
+					while account is not None and not (account in account_dates and account_dates[account] <= transaction.date):
+						account_dates[account] = transaction.date
+						account = account.parent
+					name = posting.amount.commodity.name
+					if commodity_dates.get(name, transaction.date) >= transaction.date:
+						commodity_dates[name] = transaction.date
+			self._first_dates = (account_dates, commodity_dates)
+		
+		return self._first_dates
+	
+	def _get_account_index(self):
+		# Return a dict of Account -> (list of dates, list of postings, list of transactions) in date order, or None if the transactions are not in date order
+		# Built on first use rather than when parsing, and shared with views of the ledger up to a date
+		if not self._get_dates():
+			return None
+		
+		if self._account_index is None and self._index_base is not None:
+			index = self._index_base._get_account_index()
+			if index is None:
+				self._index_base = None
+				self._index_date = None
+			else:
+				self._account_index = dict(index) # Entries are copied on write
+		
+		if self._account_index is None:
+			index = {}
+			for transaction in self._transactions:
+				for posting in transaction.postings:
+					entry = index.get(posting.account)
+					if entry is None:
+						entry = index[posting.account] = ([], [], [])
+					entry[0].append(transaction.date)
+					entry[1].append(posting)
+					entry[2].append(transaction)
+			self._account_index = index
+		
+		return self._account_index
+	
+	def _index_range(self, dates, date_beg, date_end):
+		# Return the range of an account's entries in the account index dated within [date_beg, date_end], and not after the date of a shared index
+		if self._index_date is not None and (date_end is None or date_end > self._index_date):
+			date_end = self._index_date
+		lo = 0 if date_beg is None else bisect.bisect_left(dates, date_beg)
+		hi = len(dates) if date_end is None else bisect.bisect_right(dates, date_end)
+		return lo, hi
+	
+	def add_transaction(self, transaction, at_start=False):
+		# Add a transaction in date order, before (at_start) or after other transactions on the same date
+		dates = self._get_dates()
+		self._first_dates = None
+		if not dates:
+			self._transactions.append(transaction)
+			if dates is False:
+				self._unsorted_count += 1
+			return
+		
+		bisect_date = bisect.bisect_left if at_start else bisect.bisect_right
+		
+		index = bisect_date(dates, transaction.date)
+		self._transactions.insert(index, transaction)
+		dates.insert(index, transaction.date)
+		
+		if self._index_date is not None and transaction.date > self._index_date:
+			# Would be hidden among the entries of the shared index after the date, so build an index of this ledger alone
+			self._account_index = None
+			self._index_base = None
+			self._index_date = None
+		
+		if self._account_index is not None:
+			for posting in transaction.postings:
+				# Copy rather than modify the entry, as it may be shared with a clone
+				acc_dates, acc_postings, acc_transactions = self._account_index.get(posting.account, ([], [], []))
+				index = bisect_date(acc_dates, transaction.date)
+				self._account_index[posting.account] = (acc_dates[:index] + [transaction.date] + acc_dates[index:], acc_postings[:index] + [posting] + acc_postings[index:], acc_transactions[:index] + [transaction] + acc_transactions[index:])
+	
+	def transactions_between(self, date_beg, date_end):
+		# Return the transactions dated within [date_beg, date_end], where None is unbounded
+		dates = self._get_dates()
+		if not dates:
+			return [t for t in self._transactions if (date_beg is None or t.date >= date_beg) and (date_end is None or t.date <= date_end)]
+		
+		lo = 0 if date_beg is None else bisect.bisect_left(dates, date_beg)
+		hi = len(dates) if date_end is None else bisect.bisect_right(dates, date_end)
+		return self._transactions[lo:hi]
+	
+	def account_postings(self, account, date_beg=None, date_end=None):
+		# Return the postings to the account in transactions dated within [date_beg, date_end], where None is unbounded
+		index = self._get_account_index()
+		if index is None:
+			return [p for t in self.transactions_between(date_beg, date_end) for p in t.postings if p.account == account]
+		
+		dates, postings, transactions = index.get(account, ([], [], []))
+		lo, hi = self._index_range(dates, date_beg, date_end)
+		return postings[lo:hi]
+	
+	def account_transactions(self, account, date_beg=None, date_end=None):
+		# Return the transactions dated within [date_beg, date_end] with postings to the account, where None is unbounded
+		index = self._get_account_index()
+		if index is None:
+			return [t for t in self.transactions_between(date_beg, date_end) if any(p.account == account for p in t.postings)]
+		
+		dates, postings, transactions = index.get(account, ([], [], []))
+		lo, hi = self._index_range(dates, date_beg, date_end)
+		
+		# Postings of the same transaction are adjacent
+		result = []
+		for transaction in transactions[lo:hi]:
+			if not result or result[-1] is not transaction:
+				result.append(transaction)
 		return result
 	
 	def get_account(self, name):
@@ -48,36 +270,265 @@ class Ledger:
 		if name in self.accounts:
 			return self.accounts[name]
 		
-		account = Account(self, name)
-		if account.parent:
-			account.parent.children.append(account)
-		self.accounts[name] = account
+		# The account tree may be shared between threads, so must not gain the same account twice
+		with _account_lock:
+			if name in self.accounts:
+				return self.accounts[name]
+			
+			# The account may be in the tree but not listed in this view of the ledger
+			account = self._account_table.get(name)
+			if account is None:
+				parent = self.get_account(name[:name.rfind(':')] if ':' in name else '')
+				account = Account(self, name, parent)
+				parent.children.append(account)
+				self._account_table[name] = account
+			else:
+				self.get_account(account.parent.name)
+			self.accounts[name] = account
 		
 		return account
 	
+	# Account types are computed once on creation, so must be recomputed if the config changes
+	def classify_accounts(self):
+		self.root_account.classify()
+		for account in self.accounts.values():
+			account.classify()
+	
+	# Give this ledger its own account tree, so accounts can be added or unlinked without affecting other views of the ledger
+	# Postings still refer to the shared accounts, so balances must be looked up by account name
+	def detach_accounts(self):
+		accounts = self.accounts
+		self.root_account = Account(self, '')
+		self.accounts = {}
+		self._account_table = self.accounts
+		for name in accounts:
+			self.get_account(name)
+	
 	def get_commodity(self, name):
 		return self.commodities[name]
 	
+	def intern_commodity(self, commodity):
+		# Return the shared instance of a commodity equal to this one (and formatted the same), adding it if necessary
+		key = (commodity.key, commodity.is_prefix, commodity.is_space)
+		return self._commodity_table.setdefault(key, commodity)
+	
+	@property
+	def prices(self):
+		return self._prices
+	
+	@prices.setter
+	def prices(self, prices):
+		self._prices = prices if isinstance(prices, PriceDB) else PriceDB(prices)
+	
 	def get_price(self, commodity_from, commodity_to, date):
-		prices = [p for p in self.prices if p[1] == commodity_from.name and p[2].commodity == commodity_to and p[0].date() <= date.date()]
+		return self.prices.get_price(commodity_from, commodity_to, date)
+	
+	def has_price(self, commodity):
+		return self.prices.has_price(commodity)
+	
+	def account_balances(self, date_beg=None, date_end=None, accounts=None):
+		# Return a dict of Account -> Balance of the postings to each account dated within [date_beg, date_end], where None is unbounded
+		# Only accounts with postings in the range (and in accounts, if given) are included
+		index = self._get_account_index()
+		balances = {}
 		
-		if not prices:
-			raise Exception('No price information for {} to {} at {:%Y-%m-%d}'.format(commodity_from, commodity_to, date))
+		if index is None:
+			accounts = None if accounts is None else set(accounts)
+			for transaction in self.transactions_between(date_beg, date_end):
+				for posting in transaction.postings:
+					if accounts is None or posting.account in accounts:
+						balances.setdefault(posting.account, MutableBalance())
+						balances[posting.account] += posting.amount
+		else:
+			# Sum postings grouped by account, using the index
+			for account in (index if accounts is None else accounts):
+				dates, postings, transactions = index.get(account, ([], [], []))
+				lo, hi = self._index_range(dates, date_beg, date_end)
+				if lo < hi:
+					balances[account] = MutableBalance(p.amount for p in postings[lo:hi])
 		
-		return max(prices, key=lambda p: p[0])[2]
+		return {account: balance.to_balance() for account, balance in balances.items()}
 	
 	def get_balance(self, account, date=None):
-		result = Balance()
+		result = MutableBalance()
 		
-		for transaction in self.transactions:
-			if date is None or transaction.date <= date:
-				for posting in transaction.postings:
-					if posting.account == account:
-						result += posting.amount
+		for posting in self.account_postings(account, None, date):
+			result += posting.amount
 		
+		return result.to_balance()
+
+class LedgerOverlay(Ledger):
+	# Ledger with transactions added on top of a base ledger, without copying the transactions of the base ledger
+	# Used for the adjustments (unrealized gains, reversals) made for a particular report, so each report needs memory only for its adjustments
+	
+	def __init__(self, base):
+		self.base = base
+		self.date = base.date
+		
+		self.root_account = base.root_account
+		self.accounts = base.accounts
+		self._account_table = base._account_table
+		self.commodities = base.commodities
+		self._commodity_table = base._commodity_table
+		self.prices = base.prices
+		self.sources = base.sources
+		
+		self.added = [] # (Transaction, at_start) in the order added
+		self._keys = [] # Sort keys of the added transactions, relative to the base transactions
+		self._added_transactions = [] # Added transactions, sorted by key
+		self._added_keys = {} # Added transaction -> sort key
+		self._transactions = None
+	
+	def clone(self):
+		result = LedgerOverlay(self.base)
+		for transaction, at_start in self.added:
+			result.add_transaction(transaction, at_start)
 		return result
+	
+	def copy(self):
+		result = self.base.copy()
+		result.transactions = self.transactions[:]
+		return result
+	
+	def at_date(self, date):
+		result = LedgerOverlay(self.base.at_date(date))
+		for transaction, at_start in self.added:
+			if transaction.date <= date:
+				result.add_transaction(transaction, at_start)
+		return result
+	
+	# On the same date, transactions added at the start come before those of the base ledger (most recently added first), and others after (least recently added first)
+	
+	def _base_key(self, transaction):
+		return (transaction.date, 1, 0)
+	
+	def _merge(self, base_transactions, added_transactions):
+		# Merge lists of transactions of the base ledger and added transactions, each in order
+		if not added_transactions:
+			return base_transactions
+		return [t for _, t in heapq.merge(((self._base_key(t), t) for t in base_transactions), ((self._added_keys[t], t) for t in added_transactions), key=lambda x: x[0])]
+	
+	@property
+	def transactions(self):
+		if self._transactions is None:
+			self._transactions = self._merge(self.base.transactions, self._added_transactions)
+		return self._transactions
+	
+	@transactions.setter
+	def transactions(self, transactions):
+		raise Exception('Cannot replace the transactions of a LedgerOverlay; use copy()')
+	
+	def add_transaction(self, transaction, at_start=False):
+		self.added.append((transaction, at_start))
+		key = (transaction.date, 0, -len(self.added)) if at_start else (transaction.date, 2, len(self.added))
+		
+		index = bisect.bisect(self._keys, key)
+		self._keys.insert(index, key)
+		self._added_transactions.insert(index, transaction)
+		self._added_keys[transaction] = key
+		self._transactions = None
+	
+	def _added_between(self, date_beg, date_end):
+		lo = 0 if date_beg is None else bisect.bisect_left(self._keys, (date_beg,))
+		hi = len(self._keys) if date_end is None else bisect.bisect_left(self._keys, (date_end, 3))
+		return self._added_transactions[lo:hi]
+	
+	def transactions_between(self, date_beg, date_end):
+		return self._merge(self.base.transactions_between(date_beg, date_end), self._added_between(date_beg, date_end))
+	
+	def account_postings(self, account, date_beg=None, date_end=None):
+		postings = self.base.account_postings(account, date_beg, date_end)
+		added = [t for t in self._added_between(date_beg, date_end) if any(p.account == account for p in t.postings)]
+		if not added:
+			return postings
+		
+		result = []
+		for _, item in heapq.merge(((self._base_key(p.transaction), p) for p in postings), ((self._added_keys[t], t) for t in added), key=lambda x: x[0]):
+			if isinstance(item, Transaction):
+				result.extend(p for p in item.postings if p.account == account)
+			else:
+				result.append(item)
+		return result
+	
+	def account_transactions(self, account, date_beg=None, date_end=None):
+		transactions = self.base.account_transactions(account, date_beg, date_end)
+		added = [t for t in self._added_between(date_beg, date_end) if any(p.account == account for p in t.postings)]
+		return self._merge(transactions, added)
+	
+	def account_balances(self, date_beg=None, date_end=None, accounts=None):
+		added = self._added_between(date_beg, date_end)
+		if not added:
+			return self.base.account_balances(date_beg, date_end, accounts)
+		
+		accounts = None if accounts is None else set(accounts)
+		balances = {account: MutableBalance(balance.amounts) for account, balance in self.base.account_balances(date_beg, date_end, accounts).items()}
+		for transaction in added:
+			for posting in transaction.postings:
+				if accounts is None or posting.account in accounts:
+					balances.setdefault(posting.account, MutableBalance())
+					balances[posting.account] += posting.amount
+		
+		return {account: balance.to_balance() for account, balance in balances.items()}
+
+class PriceDB:
+	# List of (date, commodity name, price Amount), indexed by commodity pair for lookups
+	
+	def __init__(self, prices=None):
+		self.prices = list(prices or [])
+		self._index = None # (index, set of priced commodity names), built on first use
+	
+	def __iter__(self):
+		return iter(self.prices)
+	
+	def __len__(self):
+		return len(self.prices)
+	
+	def append(self, price):
+		with _price_lock:
+			self.prices.append(price)
+			self._index = None
+	
+	def _get_index(self):
+		# The PriceDB may be shared between threads, so the index and the set of priced commodities are built together and published at once
+		index = self._index
+		if index is None:
+			with _price_lock:
+				if self._index is None:
+					self._index = self._build_index()
+				index = self._index
+		return index
+	
+	def _build_index(self):
+		# (commodity from name, commodity to name) -> (list of dates, list of prices), sorted by date
+		index = {}
+		for price in sorted(self.prices, key=lambda p: p[0]):
+			days, prices = index.setdefault((price[1], price[2].commodity.name), ([], []))
+			days.append(price[0].date())
+			prices.append(price)
+		return index, set(p[1] for p in self.prices)
+	
+	def has_price(self, commodity):
+		return commodity.name in self._get_index()[1]
+	
+	def get_price(self, commodity_from, commodity_to, date):
+		days, prices = self._get_index()[0].get((commodity_from.name, commodity_to.name), ((), ()))
+		
+		# Find the latest price on or before the date, preferring the earliest listed of equally recent prices
+		result = None
+		for i in reversed(range(bisect.bisect_right(days, date.date()))):
+			if result is not None and prices[i][0] != result[0]:
+				break
+			if prices[i][2].commodity == commodity_to:
+				result = prices[i]
+		
+		if result is None:
+			raise Exception('No price information for {} to {} at {:%Y-%m-%d}'.format(commodity_from, commodity_to, date))
+		
+		return result[2]
 
 class Transaction:
+	__slots__ = ['ledger', 'id', 'date', 'description', 'code', 'uuid', 'metadata', 'postings']
+	
 	def __init__(self, ledger, id, date, description, code=None, uuid=None, metadata=None):
 		self.ledger = ledger
 		self.id = id
@@ -193,6 +644,8 @@ class Transaction:
 		return result
 
 class Posting:
+	__slots__ = ['transaction', 'account', 'amount', 'comment', 'state']
+	
 	class State(Enum):
 		UNCLEARED = 0
 		CLEARED = 1
@@ -215,61 +668,72 @@ class Posting:
 		return Posting(self.transaction, self.account, self.amount.exchange(commodity, True), self.comment, self.state) # Cost basis
 
 class Account:
-	def __init__(self, ledger, name):
+	# Bits of Account.types
+	INCOME = 1
+	EXPENSE = 2
+	EQUITY = 4
+	ASSET = 8
+	LIABILITY = 16
+	CASH = 32
+	OCI = 64
+	COST = INCOME | EXPENSE | EQUITY
+	MARKET = ASSET | LIABILITY
+	
+	__slots__ = ['ledger', 'name', 'children', 'bits', 'parent', 'depth', 'types', 'is_income', 'is_expense', 'is_equity', 'is_asset', 'is_liability', 'is_cash', 'is_oci', 'is_cost', 'is_market']
+	
+	def __init__(self, ledger, name, parent=None):
 		self.ledger = ledger
 		self.name = name
 		
 		self.children = []
+		
+		# The hierarchy is fixed by the name, so compute it once here rather than on every access
+		self.bits = name.split(':')
+		self.parent = parent
+		self.depth = parent.depth + 1 if parent else 0
+		
+		self.classify()
 	
 	def __repr__(self):
 		return '<Account {}>'.format(self.name)
 	
-	@property
-	def bits(self):
-		return self.name.split(':')
-	
-	@property
-	def parent(self):
-		if self.name == '':
-			return None
-		return self.ledger.get_account(':'.join(self.bits[:-1]))
-	
 	def matches(self, part):
 		if self.name == part or self.name.startswith(part + ':'):
 			return True
 		return False
 	
-	@property
-	def is_income(self):
-		return self.matches(config['income_account'])
-	@property
-	def is_expense(self):
-		return self.matches(config['expenses_account'])
-	@property
-	def is_equity(self):
-		return self.matches(config['equity_account'])
-	@property
-	def is_asset(self):
-		return self.matches(config['assets_account'])
-	@property
-	def is_liability(self):
-		return self.matches(config['liabilities_account'])
-	@property
-	def is_cash(self):
-		# Is this a cash asset?
-		return any(self.matches(a) for a in config['cash_asset_accounts'])
-	@property
-	def is_oci(self):
-		return self.matches(config['oci_account'])
-	
-	@property
-	def is_cost(self):
-		return self.is_income or self.is_expense or self.is_equity
-	@property
-	def is_market(self):
-		return self.is_asset or self.is_liability
+	# (Re)compute the account types from the config
+	def classify(self):
+		types = 0
+		if self.matches(config['income_account']):
+			types |= Account.INCOME
+		if self.matches(config['expenses_account']):
+			types |= Account.EXPENSE
+		if self.matches(config['equity_account']):
+			types |= Account.EQUITY
+		if self.matches(config['assets_account']):
+			types |= Account.ASSET
+		if self.matches(config['liabilities_account']):
+			types |= Account.LIABILITY
+		if any(self.matches(a) for a in config['cash_asset_accounts']):
+			types |= Account.CASH
+		if self.matches(config['oci_account']):
+			types |= Account.OCI
+		
+		self.types = types
+		self.is_income = bool(types & Account.INCOME)
+		self.is_expense = bool(types & Account.EXPENSE)
+		self.is_equity = bool(types & Account.EQUITY)
+		self.is_asset = bool(types & Account.ASSET)
+		self.is_liability = bool(types & Account.LIABILITY)
+		self.is_cash = bool(types & Account.CASH) # Is this a cash asset?
+		self.is_oci = bool(types & Account.OCI)
+		self.is_cost = bool(types & Account.COST)
+		self.is_market = bool(types & Account.MARKET)
 
 class Amount:
+	__slots__ = ['amount', 'commodity']
+	
 	def __init__(self, amount, commodity=None):
 		if isinstance(amount, Amount):
 			self.amount = amount.amount
@@ -374,7 +838,7 @@ class Amount:
 			return Amount(self.amount * price.amount, commodity)
 		
 		if date and ledger:
-			if any(p[1] == self.commodity.name for p in ledger.prices):
+			if ledger.has_price(self.commodity):
 				# This commodity has price information
 				# Measured at fair value
 				return self.exchange(commodity, is_cost, ledger.get_price(self.commodity, commodity, date))
@@ -404,14 +868,10 @@ class Balance:
 		self.amounts = amounts or []
 	
 	def strip_prices(self):
-		new_amounts = []
+		result = MutableBalance()
 		for amount in self.amounts:
-			new_amount = next((a for a in new_amounts if a.commodity.name == amount.commodity.name), None)
-			if new_amount is None:
-				new_amounts.append(Amount(amount.amount, amount.commodity.strip_price()))
-			else:
-				new_amount.amount += amount.amount
-		return Balance(new_amounts)
+			result += Amount(amount.amount, amount.commodity.strip_price())
+		return result.to_balance()
 	
 	def clean(self):
 		return Balance([a for a in self.amounts if a != 0])
@@ -439,52 +899,89 @@ class Balance:
 			raise TypeError('Cannot compare Balance with non-zero number')
 	
 	def __add__(self, other):
-		new_amounts = [Amount(a) for a in self.amounts]
-		
-		if isinstance(other, Balance):
+		result = MutableBalance(self.amounts)
+		result += other
+		return result.to_balance()
+	
+	def __sub__(self, other):
+		return self + (-other)
+
+class MutableBalance:
+	# Balance which is accumulated in place, with amounts keyed by commodity
+	# Used for accumulating postings; convert to a Balance with to_balance
+	
+	def __init__(self, amounts=()):
+		self._amounts = {}
+		for amount in amounts:
+			self += amount
+	
+	def _add(self, amount):
+		existing = self._amounts.get(amount.commodity)
+		if existing is None:
+			self._amounts[amount.commodity] = Amount(amount)
+		else:
+			existing.amount += amount.amount
+	
+	def __iadd__(self, other):
+		if isinstance(other, (Balance, MutableBalance)):
 			for amount in other.amounts:
-				new_amount = next((a for a in new_amounts if a.commodity == amount.commodity), None)
-				if new_amount is None:
-					new_amount = Amount(0, amount.commodity)
-					new_amounts.append(new_amount)
-				new_amount.amount += amount.amount
-				
-				#if new_amount == 0:
-				#	new_amounts.remove(new_amount)
+				self._add(amount)
 		elif isinstance(other, Amount):
-			new_amount = next((a for a in new_amounts if a.commodity == other.commodity), None)
-			if new_amount is None:
-				new_amount = Amount(0, other.commodity)
-				new_amounts.append(new_amount)
-			new_amount.amount += other.amount
-			
-			#if new_amount == 0:
-			#	new_amounts.remove(new_amount)
+			self._add(other)
 		elif other == 0:
 			pass
 		else:
 			raise Exception('NYI')
-		
-		return Balance(new_amounts)
+		return self
 	
-	def __sub__(self, other):
-		return self + (-other)
+	def __isub__(self, other):
+		self += -other
+		return self
+	
+	@property
+	def amounts(self):
+		return list(self._amounts.values())
+	
+	def to_balance(self):
+		return Balance([Amount(a) for a in self._amounts.values()])
 
 class Commodity:
+	__slots__ = ['name', 'is_prefix', 'is_space', 'price', '_hash']
+	
 	def __init__(self, name, is_prefix, is_space, price=None):
 		self.name = name
 		self.is_prefix = is_prefix
 		self.is_space = is_space
 		self.price = price
+		
+		self._hash = None
 	
 	def __repr__(self):
 		return '<Commodity {} ({})>'.format(self.name, 'prefix' if self.is_prefix else 'suffix')
 	
 	def __eq__(self, other):
+		if self is other:
+			# Commodities are interned by the Ledger, so equal commodities are usually identical
+			return True
 		if not isinstance(other, Commodity):
 			return False
 		return self.name == other.name and self.price == other.price
 	
+	def __hash__(self):
+		# Commodities should not be modified once created, so the hash is computed once
+		if self._hash is None:
+			self._hash = hash(self.key)
+		return self._hash
+	
+	@property
+	def key(self):
+		# Hashable key, equal for equal commodities
+		if self.price is None:
+			return (self.name, None)
+		if self.price.amount == 0:
+			return (self.name, 0)
+		return (self.name, self.price.commodity.key, self.price.amount)
+	
 	def strip_price(self):
 		return Commodity(self.name, self.is_prefix, self.is_space)
 
@@ -497,8 +994,107 @@ class TrialBalance:
 		
 		self.balances = {}
 	
+	@property
+	def balances(self):
+		return self._balances
+	
+	@balances.setter
+	def balances(self, balances):
+		self._balances = TrialBalanceDict(self, balances)
+		self._totals = None
+		self._exchanged = {}
+	
 	def get_balance(self, account):
 		return self.balances.get(account.name, Balance())
 	
 	def get_total(self, account):
-		return self.get_balance(account) + sum((self.get_total(a) for a in account.children), Balance())
+		if self._totals is None:
+			self._totals = self._compute_totals()
+		
+		total = self._totals.get(account.name)
+		if total is None:
+			# Account not (or no longer) reachable from the root, e.g. a separate P&L account
+			total = self.get_balance(account) + sum((self.get_total(a) for a in account.children), Balance())
+		return total
+	
+	# Balance and total of the account in the given commodity, at cost or market value as at the trial balance date
+	# Templates and zero-balance pruning ask for the same figures repeatedly, so these are cached like the totals
+	def get_balance_exchanged(self, account, commodity, is_cost=True):
+		return self._get_exchanged(False, account, commodity, is_cost)
+	
+	def get_total_exchanged(self, account, commodity, is_cost=True):
+		return self._get_exchanged(True, account, commodity, is_cost)
+	
+	def _get_exchanged(self, is_total, account, commodity, is_cost):
+		key = (is_total, account.name, commodity.key, is_cost)
+		amount = self._exchanged.get(key)
+		if amount is None:
+			balance = self.get_total(account) if is_total else self.get_balance(account)
+			if is_cost:
+				amount = balance.exchange(commodity, True)
+			else:
+				amount = balance.exchange(commodity, False, self.date, self.ledger)
+			self._exchanged[key] = amount
+		return amount
+	
+	# Discard cached totals, e.g. after the account tree has been changed
+	def invalidate(self):
+		self._totals = None
+		self._exchanged = {}
+	
+	# Roll up the totals of every account in a single post-order traversal of the account tree
+	def _compute_totals(self):
+		totals = {}
+		
+		stack = [(self.ledger.root_account, False)]
+		while stack:
+			account, visited = stack.pop()
+			if not visited:
+				stack.append((account, True))
+				stack.extend((child, False) for child in account.children)
+				continue
+			
+			total = MutableBalance(self.get_balance(account).amounts)
+			for child in account.children:
+				total += totals[child.name]
+			totals[account.name] = total.to_balance()
+		
+		return totals
+
+class TrialBalanceDict(dict):
+	# dict of balances which discards the cached totals of its TrialBalance when changed
+	
+	def __init__(self, trial_balance, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.trial_balance = trial_balance
+	
+	def __reduce__(self):
+		return (TrialBalanceDict, (self.trial_balance, dict(self)))
+	
+	def __setitem__(self, key, value):
+		super().__setitem__(key, value)
+		self.trial_balance.invalidate()
+	
+	def __delitem__(self, key):
+		super().__delitem__(key)
+		self.trial_balance.invalidate()
+	
+	def clear(self):
+		super().clear()
+		self.trial_balance.invalidate()
+	
+	def pop(self, *args):
+		self.trial_balance.invalidate()
+		return super().pop(*args)
+	
+	def popitem(self):
+		self.trial_balance.invalidate()
+		return super().popitem()
+	
+	def setdefault(self, key, default=None):
+		self.trial_balance.invalidate()
+		return super().setdefault(key, default)
+	
+	def update(self, *args, **kwargs):
+		super().update(*args, **kwargs)
+		self.trial_balance.invalidate()